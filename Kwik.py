@@ -9,6 +9,7 @@ Loads .kwd files
 """
 
 import h5py
+import time
 import numpy as np
 
 def load(filename, dataset=0):
@@ -29,16 +30,100 @@ def load(filename, dataset=0):
                          
     return data
     
-def convert(filename, filetype='dat', dataset=0):
-
+def convert(filename, filetype='dat', dataset=0, order=None, scale=False,
+            buffer_bytes=64 * 2**20, verbose=True):
+    """
+    Stream recordings from a .kwd file into a flat binary file.
+    
+    Data is read in blocks aligned to the HDF5 chunk layout into a
+    preallocated buffer of about buffer_bytes, and written sequentially, so
+    memory use does not depend on the size of the recording.
+    
+    Args:
+        filename: .kwd file to convert. The output is written next to it,
+            with the extension replaced by filetype.
+        filetype: only 'dat' is supported.
+        dataset: recording to convert, or 'all' to write every recording,
+            in order, into the same file.
+        order: optional list of channel indices, the order in which
+            channels are written.
+        scale: if True, multiply by channel_bit_volts and write float32
+            instead of int16.
+        buffer_bytes: approximate size of the read/write buffer.
+        verbose: print the throughput.
+    """
     f = h5py.File(filename, 'r')
     fnameout = filename[:-3] + filetype
 
-    if filetype == 'dat':    
-        data = f['recordings'][str(dataset)]['data'][:,:]
-        data.tofile(fnameout)
+    if filetype == 'dat':
+        if dataset == 'all':
+            datasets = sorted(f['recordings'].keys(), key=int)
+        else:
+            datasets = [str(dataset)]
+        
+        t0 = time.time()
+        n_bytes = 0
+        with open(fnameout, 'wb') as out:
+            for rec in datasets:
+                n_bytes += _stream_recording(f['recordings'][rec], out, order,
+                                             scale, buffer_bytes)
+        
+        if verbose:
+            elapsed = max(time.time() - t0, 1e-9)
+            print('Wrote %.1f MB to %s in %.2f s (%.1f MB/s)' % (
+                n_bytes / 1e6, fnameout, elapsed, n_bytes / 1e6 / elapsed))
+    
+    f.close()
+
+
+def _stream_recording(recording, out, order=None, scale=False,
+                      buffer_bytes=64 * 2**20):
+    # Write one recording group to the open file `out`, block by block.
+    # Returns the number of bytes written.
+    data = recording['data']
+    n_samples, n_channels = data.shape
+    if order is None:
+        order = np.arange(n_channels)
+    order = np.asarray(order)
+    
+    # Blocks span whole HDF5 chunks along time, with all channels
+    row_bytes = n_channels * data.dtype.itemsize
+    block_rows = max(buffer_bytes // row_bytes, 1)
+    if data.chunks is not None:
+        chunk_rows = data.chunks[0]
+        block_rows = max(block_rows // chunk_rows, 1) * chunk_rows
+    block_rows = min(block_rows, max(n_samples, 1))
+    
+    buf = np.empty((block_rows, n_channels), dtype=data.dtype)
+    if scale:
+        if 'channel_bit_volts' in recording.get('application_data', {}):
+            bit_volts = recording['application_data']['channel_bit_volts'][:]
+        else:
+            # Old OE versions do not have channel_bit_volts info.
+            bit_volts = np.full(n_channels, 0.195)
+        bit_volts = np.asarray(bit_volts, dtype=np.float32)[order]
+        out_buf = np.empty((block_rows, len(order)), dtype=np.float32)
+    else:
+        out_buf = np.empty((block_rows, len(order)), dtype=data.dtype)
+    
+    n_bytes = 0
+    for start in range(0, n_samples, block_rows):
+        stop = min(start + block_rows, n_samples)
+        n = stop - start
+        data.read_direct(buf, np.s_[start:stop], np.s_[0:n])
+        
+        block = out_buf[:n]
+        if scale:
+            np.multiply(buf[:n, order], bit_volts, out=block)
+        else:
+            block[...] = buf[:n, order]
+        
+        block.tofile(out)
+        n_bytes += block.nbytes
     
+    return n_bytes
     
+
 def write(filename, dataset=0, bit_depth=1.0, sample_rate=25000.0):
     
     f = h5py.File(filename, 'w-')
@@ -57,11 +57,29 @@ import struct
 import json
 from copy import deepcopy
 import re
+from multiprocessing.pool import ThreadPool
+
+# os.scandir only exists from Python 3.5, the backport is optional
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
 
 # constants for pre-allocating matrices:
 MAX_NUMBER_OF_SPIKES = 1e6
 MAX_NUMBER_OF_EVENTS = 1e6
 
+# Layout of each 16-byte record in an .events file
+EVENT_DTYPE = np.dtype([
+    ('timestamps', '<i8'),
+    ('sampleNum', '<i2'),
+    ('eventType', '<u1'),
+    ('nodeId', '<u1'),
+    ('eventId', '<u1'),
+    ('channel', '<u1'),
+    ('recordingNumber', '<u2'),
+    ])
+
 def load(filepath):
     
     # redirects to code for individual file types
@@ -103,7 +121,7 @@ def loadFolder(folderpath,**kwargs):
 
 def loadFolderToArray(folderpath, channels='all', dtype=float, 
     source='100', recording=None, start_record=None, stop_record=None,
-    verbose=True):
+    verbose=True, n_jobs=1, header=None):
     """Load the neural data files in a folder to a single array.
     
     By default, all channels in the folder are loaded in numerical order.
@@ -126,8 +144,15 @@ def loadFolderToArray(folderpath, channels='all', dtype=float,
             `stop_record` is not inclusive. If `start_record` is None, 
             start at the beginning; if `stop_record` is None, read to the end.
         verbose : print status updateds
-    
-    Returns: numpy array of shape (n_samples, n_channels)
+        n_jobs : int, number of threads loading channels in parallel. Each
+            channel is decoded straight into its own contiguous row of a
+            preallocated array, by numpy code that releases the GIL.
+        header : the header returned by get_header_from_folder for these
+            files. If None, it is read here; pass it when loading many
+            chunks of the same files, as pack does.
+    
+    Returns: numpy array of shape (n_samples, n_channels). It is Fortran
+        ordered, i.e. the transpose of a (n_channels, n_samples) array.
     """
     # Get list of files
     filelist = get_filelist(folderpath, source, channels, recording=None)
@@ -136,33 +161,45 @@ def loadFolderToArray(folderpath, channels='all', dtype=float,
     t0 = time.time()
 
     # Get the header info and use this to set start_record and stop_record
-    header = get_header_from_folder(folderpath, filelist)
+    if header is None:
+        header = get_header_from_folder(folderpath, filelist, n_jobs)
     if start_record is None:
         start_record = 0
     if stop_record is None:
         stop_record = header['n_records']
 
-    # Extract each channel in order
-    arr_l = []
-    for filename in filelist:
-        arr = loadContinuous(os.path.join(folderpath, filename), dtype,
+    # Every file has the same number of records, see get_header_from_folder
+    n_records = min(stop_record, header['n_records'] - 1) - start_record
+    n_samples = max(n_records, 0) * header['blockLength']
+    data_array = np.empty((len(filelist), n_samples), dtype=dtype)
+
+    def store_channel(i):
+        loadContinuous(os.path.join(folderpath, filelist[i]), dtype,
             start_record=start_record, stop_record=stop_record, 
-            verbose=verbose)['data']
-        arr_l.append(arr)
-    
-    # Concatenate into an array of shape (n_samples, n_channels)
-    data_array = np.transpose(arr_l)
+            verbose=verbose, out=data_array[i])
+
+    # Extract the channels in order, or in parallel
+    if n_jobs == 1:
+        for i in range(len(filelist)):
+            store_channel(i)
+    else:
+        pool = ThreadPool(n_jobs)
+        try:
+            pool.map(store_channel, range(len(filelist)))
+        finally:
+            pool.close()
     
     if verbose:
         time_taken = time.time() - t0
         print 'Avg. Load Time: %0.3f sec' % (time_taken / len(filelist))
         print 'Total Load Time: %0.3f sec' % time_taken
 
-    return data_array
+    return data_array.T
 
 
 def loadContinuous(filepath, dtype=float, verbose=True, 
-    start_record=None, stop_record=None, ignore_last_record=True):
+    start_record=None, stop_record=None, ignore_last_record=True,
+    out=None):
     """Load continuous data from a single channel in the file `filepath`.
     
     This is intended to be mostly compatible with the previous version.
@@ -175,6 +212,7 @@ def loadContinuous(filepath, dtype=float, verbose=True,
         hardcoding it.
     - Returns timestamps and recordNumbers as int instead of float
     - Tests the record metadata (N and record marker) for internal consistency
+    - Reads all records at once with a structured numpy dtype
 
     The OpenEphys file format breaks the data stream into "records", 
     typically of length 1024 samples. There is only one timestamp per record.
@@ -193,6 +231,8 @@ def loadContinuous(filepath, dtype=float, verbose=True,
         ignore_last_record : The last record in the file is almost always
             incomplete (padded with zeros). By default it is ignored, for
             compatibility with the old version of this function.
+        out : optional array of dtype `dtype` and the length of the samples
+            read, into which the samples are decoded directly.
 
     Returns: dict, with following keys
         data : array of samples of data
@@ -215,93 +255,77 @@ def loadContinuous(filepath, dtype=float, verbose=True,
     """
     # This is what the record marker should look like
     spec_record_marker = np.array([0, 1, 2, 3, 4, 5, 6, 7, 8, 255])
-
-    # Lists for data that's read
-    timestamps = []
-    recordingNumbers = []
-    samples = []
-    samples_read = 0
-    records_read = 0
     
     # Open the file
     with file(filepath, 'rb') as f:
         # Read header info, file length, and number of records
         header = readHeader(f)
-        record_length_bytes = 2 * header['blockLength'] + 22
+        record_dtype = _record_dtype(header['blockLength'])
         fileLength = os.fstat(f.fileno()).st_size
-        n_records = get_number_of_records(filepath)
+        n_records = _count_records(fileLength, header['blockLength'])
+        
+        # Skip the last record if requested, which usually contains
+        # incomplete data
+        if ignore_last_record:
+            n_records = max(n_records - 1, 0)
         
         # Use this to set start and stop records if not specified
         if start_record is None:
             start_record = 0
         if stop_record is None:
             stop_record = n_records
+        stop_record = min(stop_record, n_records)
+        n_records_to_read = max(stop_record - start_record, 0)
         
-        # We'll stop reading after this many records are read
-        n_records_to_read = stop_record - start_record
-        
-        # Seek to the start location, relative to the current position
-        # right after the header.
-        f.seek(record_length_bytes * start_record, 1)
-        
-        # Keep reading till the file is finished
-        while f.tell() < fileLength and records_read < n_records_to_read:
-            # Skip the last record if requested, which usually contains
-            # incomplete data
-            if ignore_last_record and f.tell() == (
-                fileLength - record_length_bytes):
-                break
-            
-            # Read the timestamp for this record
-            # litte-endian 64-bit signed integer
-            timestamps.append(np.fromfile(f, np.dtype('<i8'), 1))
-        
-            # Read the number of samples in this record
-            # little-endian 16-bit unsigned integer
-            N = np.fromfile(f, np.dtype('<u2'), 1).item() 
-            if N != header['blockLength']:
-                raise IOError('Found corrupted record in block ' + 
-                    str(recordNumber))
-            
-            # Read and store the recording numbers
-            # big-endian 16-bit unsigned integer
-            recordingNumbers.append(np.fromfile(f, np.dtype('>u2'), 1))
-            
-            # Read the data
-            # big-endian 16-bit signed integer
-            data = np.fromfile(f, np.dtype('>i2'), N)
-            if len(data) != N:
-                raise IOError("could not load the right number of samples")
-            
-            # Optionally convert dtype
-            if dtype == float: 
-                data = data * header['bitVolts']
-                        
-            # Store the data
-            samples.append(data)
-
-            # Extract and test the record marker
-            record_marker = np.fromfile(f, np.dtype('<u1'), 10)
-            if np.any(record_marker != spec_record_marker):
-                raise IOError("corrupted record marker at record %d" %
-                    records_read)
-            
-            # Update the count
-            samples_read += len(samples)            
-            records_read += 1
-
-    # Concatenate results, or empty arrays if no data read (which happens
-    # if start_sample is after the end of the data stream)
-    res = {'header': header}
-    if samples_read > 0:
-        res['timestamps'] = np.concatenate(timestamps)
-        res['data'] = np.concatenate(samples)
-        res['recordingNumber'] = np.concatenate(recordingNumbers)
+        # Read all the records at once, seeking to the start location
+        # relative to the current position right after the header.
+        f.seek(record_dtype.itemsize * start_record, 1)
+        records = np.fromfile(f, record_dtype, n_records_to_read)
+    
+    if len(records) != n_records_to_read:
+        raise IOError("could not load the right number of records")
+    
+    # Test the record metadata for all records at once
+    bad_N = np.flatnonzero(records['N'] != header['blockLength'])
+    if len(bad_N) > 0:
+        raise IOError('Found corrupted record in block ' + 
+            str(start_record + bad_N[0]))
+    bad_marker = np.flatnonzero(
+        np.any(records['marker'] != spec_record_marker, axis=1))
+    if len(bad_marker) > 0:
+        raise IOError("corrupted record marker at record %d" %
+            (start_record + bad_marker[0]))
+    
+    # Decode the samples, optionally into `out`, converting to
+    # microvolts if requested
+    samples = records['samples'].reshape(-1)
+    if out is None:
+        out = np.empty(len(samples), dtype=dtype)
+    if dtype == float:
+        np.multiply(samples, header['bitVolts'], out=out)
     else:
-        res['timestamps'] = np.array([], dtype=np.int)
-        res['data'] = np.array([], dtype=dtype)
-        res['recordingNumber'] = np.array([], dtype=np.int)
+        out[...] = samples
+    
+    res = {'header': header}
+    res['timestamps'] = records['timestamp'].astype(np.int64)
+    res['data'] = out
+    res['recordingNumber'] = records['recordingNumber'].astype(np.int64)
     return res
+
+def _record_dtype(block_length):
+    """Return the numpy dtype of a single record of a continuous file.
+    
+    Each record has one little-endian 64-bit timestamp, one little-endian
+    16-bit sample count (N), one big-endian 16-bit recording number,
+    N big-endian 16-bit samples and a 10-byte record marker.
+    """
+    return np.dtype([
+        ('timestamp', '<i8'),
+        ('N', '<u2'),
+        ('recordingNumber', '>u2'),
+        ('samples', '>i2', (block_length,)),
+        ('marker', '<u1', (10,)),
+        ])
     
 def loadSpikes(filepath):
     
@@ -312,104 +336,108 @@ def loadSpikes(filepath):
     f = open(filepath,'rb')
     header = readHeader(f)
     
-    if float(header[' version']) < 0.4:
+    if float(header['version']) < 0.4:
         raise Exception('Loader is only compatible with .spikes files with version 0.4 or higher')
      
     data['header'] = header 
     numChannels = int(header['num_channels'])
     numSamples = 40 # **NOT CURRENTLY WRITTEN TO HEADER**
     
-    spikes = np.zeros((MAX_NUMBER_OF_SPIKES, numSamples, numChannels))
-    timestamps = np.zeros(MAX_NUMBER_OF_SPIKES)
-    source = np.zeros(MAX_NUMBER_OF_SPIKES)
-    gain = np.zeros((MAX_NUMBER_OF_SPIKES, numChannels))
-    thresh = np.zeros((MAX_NUMBER_OF_SPIKES, numChannels))
-    sortedId = np.zeros((MAX_NUMBER_OF_SPIKES, numChannels))
-    recNum = np.zeros(MAX_NUMBER_OF_SPIKES)
+    # Every spike record repeats the number of channels and samples, so
+    # take them from the first record
+    fileLength = os.fstat(f.fileno()).st_size
+    firstRecord = f.read(_spike_dtype(0, 0).itemsize)
+    f.close()
+    if len(firstRecord) == _spike_dtype(0, 0).itemsize:
+        numChannels, numSamples = np.frombuffer(firstRecord, '<u2', 2, 19)
+    
+    # All records have the same size, so map the whole file at once
+    spike_dtype = _spike_dtype(numChannels, numSamples)
+    record_bytes = fileLength - 1024
+    if record_bytes % spike_dtype.itemsize != 0:
+        raise IOError("file does not divide evenly into full spike records")
+    numSpikes = record_bytes // spike_dtype.itemsize
+    
+    if numSpikes > 0:
+        records = np.memmap(filepath, spike_dtype, mode='r', offset=1024,
+            shape=(numSpikes,))
+    else:
+        records = np.zeros(0, spike_dtype)
     
-    currentSpike = 0
+    if (np.any(records['numChannels'] != numChannels) or 
+        np.any(records['numSamples'] != numSamples)):
+        raise IOError("spike records with different sizes found")
     
-    while f.tell() < os.fstat(f.fileno()).st_size:
-        
-        eventType = np.fromfile(f, np.dtype('<u1'),1) #always equal to 4, discard
-        timestamps[currentSpike] = np.fromfile(f, np.dtype('<i8'), 1)
-        software_timestamp = np.fromfile(f, np.dtype('<i8'), 1)
-        source[currentSpike] = np.fromfile(f, np.dtype('<u2'), 1)
-        numChannels = np.fromfile(f, np.dtype('<u2'), 1)
-        numSamples = np.fromfile(f, np.dtype('<u2'), 1)
-        sortedId[currentSpike] = np.fromfile(f, np.dtype('<u2'),1)
-        electrodeId = np.fromfile(f, np.dtype('<u2'),1)
-        channel = np.fromfile(f, np.dtype('<u2'),1)
-        color = np.fromfile(f, np.dtype('<u1'), 3)
-        pcProj = np.fromfile(f, np.float32, 2)
-        sampleFreq = np.fromfile(f, np.dtype('<u2'),1)
-        
-        waveforms = np.fromfile(f, np.dtype('<u2'), numChannels*numSamples)
-        wv = np.reshape(waveforms, (numChannels, numSamples))
-
-        gain[currentSpike,:] = np.fromfile(f, np.float32, numChannels)
-        thresh[currentSpike,:] = np.fromfile(f, np.dtype('<u2'), numChannels)
-        
-        recNum[currentSpike] = np.fromfile(f, np.dtype('<u2'), 1)       
-        
-        for ch in range(numChannels):
-            spikes[currentSpike,:,ch] = (np.float64(wv[ch])-32768)/(gain[currentSpike,ch]/1000)
-        
-        currentSpike += 1
+    gain = records['gain'].astype(np.float64)
+    
+    # Waveforms are stored as (channel, sample) for each spike
+    spikes = records['waveforms'].astype(np.float64)
+    spikes -= 32768
+    spikes /= gain[:, :, None] / 1000
         
-    data['spikes'] = spikes[:currentSpike,:,:]
-    data['timestamps'] = timestamps[:currentSpike]
-    data['source'] = source[:currentSpike]
-    data['gain'] = gain[:currentSpike,:]
-    data['thresh'] = thresh[:currentSpike,:]
-    data['recordingNumber'] = recNum[:currentSpike]
-    data['sortedId'] = sortedId[:currentSpike]
+    data['spikes'] = spikes.transpose(0, 2, 1)
+    data['timestamps'] = records['timestamp'].astype(np.float64)
+    data['source'] = records['source'].astype(np.float64)
+    data['gain'] = gain
+    data['thresh'] = records['thresh'].astype(np.float64)
+    data['recordingNumber'] = records['recordingNumber'].astype(np.float64)
+    data['sortedId'] = np.repeat(
+        records['sortedId'].astype(np.float64)[:, None], numChannels, 1)
 
     return data
+
+def _spike_dtype(numChannels, numSamples):
+    """Return the structured dtype of a single record in a .spikes file."""
+    return np.dtype([
+        ('eventType', '<u1'), # always equal to 4
+        ('timestamp', '<i8'),
+        ('software_timestamp', '<i8'),
+        ('source', '<u2'),
+        ('numChannels', '<u2'),
+        ('numSamples', '<u2'),
+        ('sortedId', '<u2'),
+        ('electrodeId', '<u2'),
+        ('channel', '<u2'),
+        ('color', '<u1', (3,)),
+        ('pcProj', np.float32, (2,)),
+        ('sampleFreq', '<u2'),
+        ('waveforms', '<u2', (numChannels, numSamples)),
+        ('gain', np.float32, (numChannels,)),
+        ('thresh', '<u2', (numChannels,)),
+        ('recordingNumber', '<u2'),
+        ])
     
 def loadEvents(filepath):
-
-    data = { }
+    """Load all events from an .events file.
     
-    print 'loading events...'
+    Each event is a 16-byte record, described by EVENT_DTYPE. The whole file
+    is read in a single pass and returned as typed columns sized exactly to
+    the number of events in the file.
     
-    f = open(filepath,'rb')
-    header = readHeader(f)
+    Returns: dict with the header and the keys timestamps (int64),
+        sampleNum (int16), eventType, nodeId, eventId, channel (uint8) and
+        recordingNumber (uint16).
+    """
+    data = { }
     
-    if float(header['version']) < 0.4:
-        raise Exception('Loader is only compatible with .events files with version 0.4 or higher')
-     
-    data['header'] = header 
+    print 'loading events...'
     
-    index = -1
-
-    channel = np.zeros(MAX_NUMBER_OF_EVENTS)
-    timestamps = np.zeros(MAX_NUMBER_OF_EVENTS)
-    sampleNum = np.zeros(MAX_NUMBER_OF_EVENTS)
-    nodeId = np.zeros(MAX_NUMBER_OF_EVENTS)
-    eventType = np.zeros(MAX_NUMBER_OF_EVENTS)
-    eventId = np.zeros(MAX_NUMBER_OF_EVENTS)
-    recordingNumber = np.zeros(MAX_NUMBER_OF_EVENTS)
-
-    while f.tell() < os.fstat(f.fileno()).st_size:
+    with open(filepath, 'rb') as f:
+        header = readHeader(f)
         
-        index += 1
+        if float(header['version']) < 0.4:
+            raise Exception('Loader is only compatible with .events files with version 0.4 or higher')
+         
+        data['header'] = header 
         
-        timestamps[index] = np.fromfile(f, np.dtype('<i8'), 1)
-        sampleNum[index] = np.fromfile(f, np.dtype('<i2'), 1)
-        eventType[index] = np.fromfile(f, np.dtype('<u1'), 1)
-        nodeId[index] = np.fromfile(f, np.dtype('<u1'), 1)
-        eventId[index] = np.fromfile(f, np.dtype('<u1'), 1)
-        channel[index] = np.fromfile(f, np.dtype('<u1'), 1)
-        recordingNumber[index] = np.fromfile(f, np.dtype('<u2'), 1)
+        record_bytes = os.fstat(f.fileno()).st_size - 1024
+        if record_bytes % EVENT_DTYPE.itemsize != 0:
+            raise IOError("file does not divide evenly into full event records")
         
-    data['channel'] = channel[:index]
-    data['timestamps'] = timestamps[:index]
-    data['eventType'] = eventType[:index]
-    data['nodeId'] = nodeId[:index]
-    data['eventId'] = eventId[:index]
-    data['recordingNumber'] = recordingNumber[:index]
-    data['sampleNum'] = sampleNum[:index]
+        events = np.fromfile(f, EVENT_DTYPE, record_bytes // EVENT_DTYPE.itemsize)
+    
+    for field in EVENT_DTYPE.names:
+        data[field] = np.ascontiguousarray(events[field])
     
     return data
     
@@ -485,9 +513,83 @@ def writeChannelMapFile(mapping, filename='mapping.prb'):
                       indent = 4, separators = (',', ': ') \
                  ) 
 
+class Reference(object):
+    """Digital referencing of int16 blocks of samples, done in place.
+    
+    Each group of channels is referenced at once. Differences are computed
+    in float32 (exact for int16), rounded and saturated to the int16 range
+    before being written back, so they never wrap around.
+    
+    Args:
+        mode : 'ave' (or 'car') for the common average, 'median' for the
+            common median, or a channel number to subtract that channel.
+        channels : channel number of each column of the blocks. Needed for
+            a single channel reference and for groups.
+        groups : channels referenced together, e.g. the channels of each
+            shank. Either a list of lists of channel numbers, or a channel
+            map as written by writeChannelMapFile, whose entries with a
+            'mapping' are used as groups. Each group is referenced to its
+            own average or median (or to the single channel). Channels in
+            no group are left unchanged.
+    """
+    def __init__(self, mode, channels=None, groups=None):
+        if mode in ('ave', 'car', 'median'):
+            self.mode = 'median' if mode == 'median' else 'ave'
+        else:
+            self.mode = 'channel'
+        self.channel = mode
+        self.channels = None if channels is None else list(channels)
+        
+        # Column indexes of each group, or all columns
+        if isinstance(groups, dict):
+            groups = [g['mapping'] if isinstance(g, dict) else g
+                for g in groups.values()
+                if not isinstance(g, dict) or 'mapping' in g]
+        if groups is None:
+            self.columns = [slice(None)]
+        else:
+            if self.channels is None:
+                raise ValueError("channels are needed to reference by groups")
+            self.columns = [
+                np.array([self.channels.index(ch) for ch in g
+                    if ch in self.channels], dtype=int)
+                for g in groups]
+            self.columns = [c for c in self.columns if len(c) > 0]
+        
+        if self.mode == 'channel':
+            if self.channels is None or self.channel not in self.channels:
+                raise ValueError("reference channel %s is not in channels" %
+                    str(self.channel))
+            self.ref_column = self.channels.index(self.channel)
+    
+    def __call__(self, block):
+        """Reference `block` of shape (n_samples, n_channels) in place.
+        
+        Returns: block
+        """
+        if self.mode == 'channel':
+            # Copied, as the reference column itself is referenced as well
+            ref = block[:, self.ref_column].astype(np.float32)
+        
+        for cols in self.columns:
+            sub = block[:, cols]
+            if self.mode == 'ave':
+                group_ref = sub.mean(axis=1, dtype=np.float64)
+            elif self.mode == 'median':
+                group_ref = np.median(sub, axis=1)
+            else:
+                group_ref = ref
+            
+            work = np.subtract(sub, group_ref[:, None], dtype=np.float32)
+            np.rint(work, out=work)
+            np.clip(work, -32768, 32767, out=work)
+            block[:, cols] = work
+        
+        return block
+
 def pack(folderpath, filename='openephys.dat', dref=None,
     chunk_size=4000, start_record=None, stop_record=None, verbose=True,
-    **kwargs):
+    groups=None, **kwargs):
     """Read OpenEphys formatted data in chunks and write to a flat binary file.
     
     The data will be written in a fairly standard binary format:
@@ -504,8 +606,10 @@ def pack(folderpath, filename='openephys.dat', dref=None,
         folderpath : string, path to folder containing all channels
         filename : name of file to store packed binary data
             If this file exists, it will be overwritten
-        dref:  Digital referencing - either supply a channel number or 
-            'ave' to reference to the average of packed channels.
+        dref:  Digital referencing - either supply a channel number, 
+            'ave' (or 'car') to reference to the average of packed channels,
+            or 'median' to reference to their median. It is applied to each
+            chunk, see Reference.
         chunk_size : the number of records (not bytes or samples!) to read at
             once. 4000 records of 64-channel data requires ~500 MB of memory.
             The record size is usually 1024 samples.
@@ -513,17 +617,31 @@ def pack(folderpath, filename='openephys.dat', dref=None,
             last record to process. If start_record is None, start at the
             beginning; if stop_record is None, go until the end.
         verbose : print out status info
+        groups : channel groups (e.g. shanks) referenced separately with
+            dref, see Reference.
         **kwargs : This is passed to loadFolderToArray for each chunk.
             See documentation there for the keywords `source`, `channels`,
             `recording`, and `ignore_last_record`.
     """
-    # Get header info to determine how many records we have to pack
+    # Get header info to determine how many records we have to pack. It is
+    # read once and reused for every chunk.
     header = get_header_from_folder(folderpath, **kwargs)
     if start_record is None:
         start_record = 0
     if stop_record is None:
         stop_record = header['n_records']
     
+    # Digital referencing, set up once for all chunks
+    reference = None
+    if dref:
+        # Figure out which channels are included
+        if 'channels' in kwargs and kwargs['channels'] != 'all':
+            channels = kwargs['channels']
+        else:
+            channels = _get_sorted_channels(folderpath,
+                source=kwargs.get('source', '100'))
+        reference = Reference(dref, channels, groups)
+    
     # Manually remove the output file if it exists (later we append)
     if os.path.exists(filename):
         if verbose:
@@ -540,7 +658,7 @@ def pack(folderpath, filename='openephys.dat', dref=None,
         # Load the chunk
         data_array = loadFolderToArray(folderpath, dtype=np.int16,
             start_record=chunk_start, stop_record=chunk_stop,
-            verbose=False, **kwargs)
+            verbose=False, header=header, **kwargs)
 
         # This only happens if we happen to be loading a chunk consisting
         # of only the last record, and also ignore_last_record is True
@@ -548,24 +666,8 @@ def pack(folderpath, filename='openephys.dat', dref=None,
             break
 
         # Digital referencing
-        if dref: 
-            # Choose a reference
-            if dref == 'ave':
-                reference = np.mean(data_array, 1)
-            else:
-                # Figure out which channels are included
-                if 'channels' in kwargs and kwargs['channels'] != 'all':
-                    channels = kwargs['channels']
-                else:
-                    channels = _get_sorted_channels(folderpath)
-                
-                # Find the reference channel
-                dref_idx = channels.index(dref)
-                reference = data_array[:, dref_idx].copy()
-            
-            # Subtract the reference
-            for i in range(data_array.shape[1]):
-                data_array[:,i] = data_array[:,i] - reference
+        if reference is not None:
+            reference(data_array)
         
         # Explicity open in append mode so we don't just overwrite
         with file(os.path.join(folderpath, filename), 'ab') as fi:
@@ -592,33 +694,85 @@ def regex_capture(pattern, list_of_strings, take_index=0):
     
     return res_l
 
-def _get_sorted_channels(folderpath, recording=None):
+def _get_sorted_channels(folderpath, recording=None, source='100'):
     """Return a sorted list of the continuous channels in folderpath.
     
     folderpath : string, path to location of continuous files on disk
     recording : None, or int
         If there is only one recording in the folder, leave as None.
         Otherwise, specify the number of the recording as an integer.
+    source : string, typically '100'
+    """
+    # The first recording has no suffix
+    if recording is None or recording == 1:
+        recording = None
+    
+    return sorted([channel for (src, prefix, channel, rec)
+        in get_folder_index(folderpath)
+        if src == source and prefix == 'CH' and rec == recording])
+
+# Matches <source>_<prefix><channel>[_<recording>].continuous
+CONTINUOUS_FILENAME = re.compile(
+    r'^(\d+)_([A-Za-z]+)(\d+)(?:_(\d+))?\.continuous$')
+
+# Cached indexes, see get_folder_index
+_folder_indexes = {}
+
+# Folders changed less than this many seconds before being listed are
+# listed again on the next call, see get_folder_index
+FOLDER_INDEX_RACY_SECONDS = 2
+
+def get_folder_index(folderpath):
+    """Return an index of the continuous files in folderpath.
+    
+    The folder is listed once, with the `scandir` package if it is
+    available and os.listdir otherwise, and each filename matched against
+    CONTINUOUS_FILENAME. The index is cached and only rebuilt when the
+    modification time of the folder changes, i.e. when files are added,
+    removed or renamed. As mtimes may have a resolution of one second,
+    a listing taken less than FOLDER_INDEX_RACY_SECONDS after the last
+    change of the folder is not reused, since a file created in the same
+    second would not change the mtime.
+    
+    folderpath : string, path to location of continuous files on disk
+    
+    Returns: dict mapping (source, prefix, channel, recording) to
+        (path, size), e.g. ('100', 'CH', 1, None) for 100_CH1.continuous
+        and ('100', 'AUX', 2, 3) for 100_AUX2_3.continuous.
     """
-    if recording is None:
-        return sorted([int(f.split('_CH')[1].split('.')[0]) for f in os.listdir(folderpath) 
-                    if '.continuous' in f and '_CH' in f]) 
+    key = os.path.abspath(folderpath)
+    mtime = os.stat(key).st_mtime
+    
+    cached = _folder_indexes.get(key)
+    if cached is not None and cached[0] == mtime and (
+        cached[2] - mtime >= FOLDER_INDEX_RACY_SECONDS):
+        return cached[1]
+    
+    listed_at = time.time()
+    if scandir is not None:
+        # a single pass, the sizes come with the directory entries
+        entries = [(entry.name, entry) for entry in scandir(key)]
     else:
-        # Form a string from the recording number
-        if recording == 1:
-            # The first recording has no suffix
-            recording_s = ''
-        else:
-            recording_s = '_%d' % recording
-        
-        # Form a regex pattern to be applied to each filename
-        # We will capture the channel number: (\d+)
-        regex_pattern = '%s_CH(\d+)%s.continuous' % ('100', recording_s)
+        entries = [(filename, None) for filename in os.listdir(key)]
+    
+    index = {}
+    for filename, entry in entries:
+        m = CONTINUOUS_FILENAME.match(filename)
+        if m is None:
+            continue
         
-        # Apply the pattern to each filename and return the captured channels
-        channel_numbers_s = regex_capture(regex_pattern, os.listdir(folderpath))
-        channel_numbers_int = map(int, channel_numbers_s)
-        return sorted(channel_numbers_int)
+        source, prefix, channel, recording = m.groups()
+        if recording is not None:
+            recording = int(recording)
+        path = os.path.join(key, filename)
+        if entry is None:
+            size = os.path.getsize(path)
+        else:
+            size = entry.stat().st_size
+        index[(source, prefix, int(channel), recording)] = (path, size)
+    
+    _folder_indexes[key] = (mtime, index, listed_at)
+    return index
 
 def get_number_of_records(filepath):
     # Open the file
@@ -628,12 +782,16 @@ def get_number_of_records(filepath):
         
         # Get file length
         fileLength = os.fstat(f.fileno()).st_size
-        
-        # Determine the number of records
-        record_length_bytes = 2 * header['blockLength'] + 22
-        n_records = int((fileLength - 1024) / record_length_bytes)
-        if (n_records * record_length_bytes + 1024) != fileLength:
-            raise IOError("file does not divide evenly into full records")
+    
+    return _count_records(fileLength, header['blockLength'])
+
+def _count_records(fileLength, blockLength):
+    """Return the number of records in a continuous file of fileLength bytes"""
+    # Determine the number of records
+    record_length_bytes = 2 * blockLength + 22
+    n_records = int((fileLength - 1024) / record_length_bytes)
+    if (n_records * record_length_bytes + 1024) != fileLength:
+        raise IOError("file does not divide evenly into full records")
     
     return n_records
 
@@ -653,7 +811,8 @@ def get_filelist(folderpath, source='100', channels='all', recording=None):
     """
     # Get all channels if requested
     if channels == 'all': 
-        channels = _get_sorted_channels(folderpath, recording=recording)    
+        channels = _get_sorted_channels(folderpath, recording=recording,
+            source=source)
     
     # Get the list of continuous filenames
     if recording is None or recording == 1:
@@ -666,10 +825,90 @@ def get_filelist(folderpath, source='100', channels='all', recording=None):
     
     return filelist
 
-def get_header_from_folder(folderpath, filelist=None, **kwargs):
+# Header keys that scan_headers returns as numeric arrays
+HEADER_FLOAT_KEYS = ['bitVolts', 'sampleRate']
+HEADER_INT_KEYS = ['blockLength', 'bufferSize', 'header_bytes']
+
+def _scan_sizes(folderpath, filelist):
+    """Return {filename: size} from a single directory scan, if the
+    `scandir` package is available (os.scandir does not exist in Python 2).
+    Otherwise return an empty dict, and sizes are taken with fstat."""
+    if scandir is None:
+        return {}
+    wanted = set(filelist)
+    return dict((entry.name, entry.stat().st_size)
+        for entry in scandir(folderpath) if entry.name in wanted)
+
+def scan_headers(folderpath, filelist=None, n_jobs=1, **kwargs):
+    """Read the headers of many continuous files in `folderpath` at once.
+    
+    Each file is opened once, optionally across a pool of `n_jobs`
+    threads. File sizes come from a single directory scan (or from fstat
+    on the same open file), so counting the records needs no extra open.
+    
+    folderpath : folder containing OpenEphys data files
+    filelist : list of filenames within `folderpath` to read
+        If None, the keyword arguments are passed to `get_filelist`.
+    n_jobs : int, number of threads reading headers
+    
+    Returns: dict of columns, with one row per file in `filelist` order.
+        The columns are 'filename', 'size' and 'n_records', plus one per
+        header key. HEADER_FLOAT_KEYS and HEADER_INT_KEYS are numpy arrays,
+        the other keys are lists of strings.
+    """
+    # Get filelist if it was not provided
+    if filelist is None:
+        filelist = get_filelist(folderpath, **kwargs)
+    sizes = _scan_sizes(folderpath, filelist)
+    
+    def read_one(filename):
+        with file(os.path.join(folderpath, filename), 'rb') as fi:
+            header = readHeader(fi)
+            if filename not in sizes:
+                header['size'] = os.fstat(fi.fileno()).st_size
+            else:
+                header['size'] = sizes[filename]
+        return header
+    
+    if n_jobs == 1:
+        headers = [read_one(filename) for filename in filelist]
+    else:
+        pool = ThreadPool(n_jobs)
+        try:
+            headers = pool.map(read_one, filelist)
+        finally:
+            pool.close()
+    
+    # Form one column per key
+    table = {'filename': list(filelist)}
+    keys = []
+    for header in headers:
+        keys.extend(key for key in header if key not in keys)
+    for key in keys:
+        column = [header.get(key) for header in headers]
+        if key in HEADER_FLOAT_KEYS:
+            column = np.array(column, dtype=float)
+        elif key in HEADER_INT_KEYS or key == 'size':
+            column = np.array(column, dtype=np.int64)
+        table[key] = column
+    
+    # Count the records of all files at once, as in _count_records
+    if len(filelist) > 0:
+        record_length_bytes = 2 * table['blockLength'] + 22
+        n_records = (table['size'] - 1024) // record_length_bytes
+        uneven = (n_records * record_length_bytes + 1024) != table['size']
+        if np.any(uneven):
+            raise IOError("file does not divide evenly into full records: "
+                + filelist[np.flatnonzero(uneven)[0]])
+        table['n_records'] = n_records
+    
+    return table
+
+def get_header_from_folder(folderpath, filelist=None, n_jobs=1, **kwargs):
     """Return the header info for all files in `folderpath`.
     
-    The header for each file is loaded individually. The following keys
+    The headers are read by `scan_headers`, which opens each file once,
+    optionally in `n_jobs` threads. The following keys
     are supposed to be the same for every file:
         ['bitVolts', 'blockLength', 'bufferSize', 'date_created',
         'description', 'format', 'header_bytes', 'sampleRate', 'version']
@@ -683,43 +922,35 @@ def get_header_from_folder(folderpath, filelist=None, **kwargs):
         If None, then provide optional keyword arguments `source`, 
         `channels`, and/or `recording`. They are passed to `get_filelist`
         to get the filenames in this folder.
+    n_jobs : int, number of threads reading headers
     
-    Returns: dict
+    Returns: dict. The per-channel headers are available from
+        `scan_headers`.
     """
     included_keys = ['blockLength', 'bufferSize', 'date_created',
         'description', 'format', 'header_bytes', 'version', 'n_records']
     included_float_keys = ['bitVolts', 'sampleRate']
     
-    # Get filelist if it was not provided
-    if filelist is None:
-        filelist = get_filelist(folderpath, **kwargs)
-    
-    # Get header for each file, as well as number of records
-    header_l = []
-    for filename in filelist:
-        full_filename = os.path.join(folderpath, filename)
-        with file(full_filename) as fi:
-            header = readHeader(fi)
-        header['n_records'] = get_number_of_records(full_filename)
-        header_l.append(header)
-    if len(header_l) == 0:
+    table = scan_headers(folderpath, filelist, n_jobs, **kwargs)
+    if len(table['filename']) == 0:
         raise IOError("no headers could be loaded")
     
-    # Form a single header based on all of them, starting with the first one
+    # Form a single header, checking each key for all files at once
     unique_header = {}
     for key in included_keys + included_float_keys:
-        unique_header[key] = header_l[0][key]
-    
-    # Check every header
-    for header in header_l:
-        # Check the regular keys
-        for key in included_keys:
-            if unique_header[key] != header[key]:
-                raise ValueError("inconsistent header info in key %s" % key)
+        column = table[key]
+        if key in included_float_keys:
+            consistent = np.allclose(column, column[0])
+        elif isinstance(column, np.ndarray):
+            consistent = np.all(column == column[0])
+        else:
+            consistent = len(set(column)) == 1
+        if not consistent:
+            raise ValueError("inconsistent header info in key %s" % key)
         
-        # Check the floating point keys
-        for key in included_float_keys:
-            if not np.isclose(unique_header[key], header[key]):
-                raise ValueError("inconsistent header info in key %s" % key)
-            
+        if isinstance(column, np.ndarray):
+            unique_header[key] = column[0].item()
+        else:
+            unique_header[key] = column[0]
+    
     return unique_header
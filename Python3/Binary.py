@@ -5,8 +5,11 @@
 @date: 2019-07-27
 
 Loads data recorded by Open Ephys in Binary format as numpy memmap.
+Events and spikes can be loaded with LoadEvents and LoadSpikes, and
+timestamps with LoadTimestamps.
 
-    DatLoad(Folder, Processor=None, Experiment=None, Recording=None, Unit='uV', ChannelMap=[])
+    Load(Folder, Processor=None, Experiment=None, Recording=None, Unit='uV', ChannelMap=[],
+         UseIndex=True, Start=None, Stop=None, TimeUnit='s')
 
 Parameters
     Folder: str
@@ -29,14 +32,31 @@ Parameters
 
     Unit: str or None, optional
         Unit to return the data, either 'uV' or 'mV' (case insensitive). In
-        both cases, return data in float32. Defaults to 'uV'.
-        If anything else, return data in int16.
+        both cases, return data as a LazyData object, which keeps the int16
+        memmap and returns float32 data converted to Unit when sliced.
+        Defaults to 'uV'. If anything else, return data in int16.
 
     ChannelMap: list, optional
         If empty (default), load all channels.
         If not empty, return only channels in ChannelMap, in the provided order.
+        The map is kept as an index in the returned LazyData object, so
+        only the mapped channels of the sliced samples are read.
         CHANNELS ARE COUNTED STARTING AT 0.
 
+    Start, Stop: float, int or None, optional
+        Time window to load, in seconds from the start of each recording if
+        TimeUnit is 's' (default), or in samples if TimeUnit is 'samples'.
+        Only this window of each file is mapped. If not set, load from the
+        beginning and/or until the end of each recording.
+
+    TimeUnit: str, optional
+        Either 's' or 'samples'. Unit of Start and Stop.
+
+    UseIndex: bool, optional
+        If True (default), save the session index built by GetIndex as a
+        sidecar file, so later calls only stat the files instead of walking
+        and parsing the whole session.
+
 Returns:
     Data: dict
         Dictionary with data in the structure Data[Processor][Experiment][Recording].
@@ -55,6 +75,9 @@ Example:
     Recording = 3
     Data2, Rate2 = Binary.Load(Folder, Recording=Recording, ChannelMap=ChannelMap, Unit='Bits')
 
+    # 10 s of one processor, starting 60 s into the recording
+    Data3, Rate3 = Binary.Load(Folder, Processor='100', Recording=Recording, Start=60, Stop=70)
+
 
 Warning:
     Data placed inside dictionaries is affected when passed to functions.
@@ -71,9 +94,208 @@ Warning:
 
 """
 #%%
+import hashlib
+import json
 import numpy as np
-from ast import literal_eval
-from glob import glob
+import os
+
+
+IndexFile = '.binary_index.json'
+IndexVersion = 2
+IndexCacheDir = os.path.join(os.path.expanduser('~'), '.cache', 'open-ephys-binary')
+
+
+class LazyData:
+    """
+    Lazy view over a recording memmap of shape (samples, channels).
+
+    Data stays as int16 in the memmap; the per-channel Scale vector (if any)
+    is only applied to the samples that are actually indexed, which are
+    returned as float32. Indexing is done on rows (samples) and channels
+    independently, i.e. Rec[Rows, Channels] always returns the
+    len(Rows) x len(Channels) block.
+
+    An optional ChannelMap selects and reorders channels. It is only
+    combined with the requested rows and channels at access time, so only
+    those are read from the memmap, and runs of consecutive channels are
+    read as slices instead of gathered one by one.
+
+    Use to_float() or np.asarray() to get the whole recording as a dense
+    array.
+    """
+
+    def __init__(self, Raw, Scale=None, ChannelMap=None):
+        self.Raw = Raw
+        self.Scale = None if Scale is None else np.asarray(Scale, dtype='float32')
+        self.ChannelMap = None if ChannelMap is None else np.asarray(ChannelMap, dtype=int)
+
+    @property
+    def Channels(self):
+        if self.ChannelMap is None: return(np.arange(self.Raw.shape[1]))
+        else: return(self.ChannelMap)
+
+    @property
+    def shape(self):
+        if self.ChannelMap is None: return(self.Raw.shape)
+        else: return((self.Raw.shape[0], len(self.ChannelMap)))
+
+    @property
+    def ndim(self): return(self.Raw.ndim)
+
+    @property
+    def dtype(self):
+        if self.Scale is None: return(self.Raw.dtype)
+        else: return(np.dtype('float32'))
+
+    def __len__(self): return(self.shape[0])
+
+    def __repr__(self):
+        return('LazyData(shape='+str(self.shape)+', dtype='+str(self.dtype)+')')
+
+    def __array__(self, dtype=None, copy=None):
+        Out = self.to_float() if self.Scale is not None else np.array(self[:,:])
+        return(Out if dtype is None else Out.astype(dtype))
+
+    def __getitem__(self, Key):
+        if not isinstance(Key, tuple): Key = (Key,)
+        if len(Key) > 2: raise IndexError('too many indices for recording data')
+        Rows = Key[0]
+        Cols = Key[1] if len(Key) == 2 else slice(None)
+
+        if self.ChannelMap is None and isinstance(Cols, slice):
+            Sel = Cols
+            Out = self.Raw[Rows][..., Cols]
+        else:
+            Sel = self.Channels[Cols]
+            Out = ReadChannels(self.Raw[Rows], Sel)
+
+        if self.Scale is None: return(Out)
+
+        Out = Out.astype('float32')
+        Out *= self.Scale[Sel]
+        return(Out)
+
+    def Map(self, ChannelMap):
+        """
+        Return a new LazyData with ChannelMap applied on top of the current
+        channel selection. No data is read.
+        """
+        return(LazyData(self.Raw, self.Scale, self.Channels[np.asarray(ChannelMap, dtype=int)]))
+
+    def copy(self): return(np.asarray(self))
+
+    def astype(self, DType): return(np.asarray(self).astype(DType))
+
+    def to_float(self, out=None, ChunkSize=2**16):
+        """
+        Return the whole recording as a dense float32 array, converting
+        ChunkSize samples at a time. If out is given, write into it.
+        """
+        if out is None: out = np.empty(self.shape, dtype='float32')
+
+        for Start in range(0, self.shape[0], ChunkSize):
+            out[Start:Start+ChunkSize] = self[Start:Start+ChunkSize]
+
+        return(out)
+
+
+class Timestamps:
+    """
+    Piecewise-linear model of the timestamps.npy of a continuous stream.
+
+    The timestamps file is memory-mapped and scanned once, in chunks, for
+    jumps (dropped samples or pauses). Time is then stored as segments of
+    consecutive samples, each defined by its first index and first
+    timestamp, so conversions between sample indices and times are binary
+    searches over the segments and no full-length time array is built.
+
+    Times are in seconds, i.e. timestamps divided by Rate. Float
+    timestamps (in seconds) are converted to samples using Rate.
+    """
+
+    def __init__(self, File, Rate, ChunkSize=2**20):
+        self.File = File
+        self.Rate = Rate
+
+        TS = np.load(File, mmap_mode='r')
+        self.Length = len(TS)
+
+        Starts = [0] if self.Length else []
+        for C in range(0, self.Length, ChunkSize):
+            First = max(C-1, 0)
+            Block = self.ToSamples(TS[First:C+ChunkSize])
+            Starts.extend(np.flatnonzero(np.diff(Block) != 1) + 1 + First)
+
+        self.SegIndex = np.array(Starts, dtype='int64')
+        self.SegTime = self.ToSamples(TS[self.SegIndex]) if self.Length else np.zeros(0, dtype='int64')
+        self.SegEnd = np.append(self.SegIndex[1:], self.Length)
+
+    def ToSamples(self, TS):
+        TS = np.asarray(TS)
+        if TS.dtype.kind == 'f': return(np.round(TS*self.Rate).astype('int64'))
+        else: return(TS.astype('int64'))
+
+    def __len__(self): return(self.Length)
+
+    def __repr__(self):
+        return('Timestamps('+str(self.Length)+' samples, '+str(len(self.SegIndex))+' segments)')
+
+    def __getitem__(self, Key):
+        if isinstance(Key, slice): Key = np.arange(*Key.indices(self.Length))
+        return(self.index_to_time(Key))
+
+    @property
+    def Segments(self):
+        """
+        Array of (StartIndex, StartTime, Length) rows, one per segment of
+        consecutive samples. StartTime is in seconds.
+        """
+        return(np.column_stack((self.SegIndex, self.SegTime/self.Rate, self.SegEnd-self.SegIndex)))
+
+    def index_to_time(self, Index):
+        """
+        Return the time in seconds of sample Index (int or array).
+        """
+        Index = np.asarray(Index)
+        Index = np.where(Index < 0, Index+self.Length, Index)
+        if Index.size and (Index.min() < 0 or Index.max() >= self.Length):
+            raise IndexError('index out of bounds for '+str(self.Length)+' samples')
+
+        Seg = np.searchsorted(self.SegIndex, Index, 'right')-1
+        return((self.SegTime[Seg] + Index - self.SegIndex[Seg]) / self.Rate)
+
+    def time_to_index(self, Time):
+        """
+        Return the index of the first sample at or after Time (seconds, float
+        or array). Times falling in a gap resolve to the first sample after
+        the gap; times after the last sample resolve to len(self).
+        """
+        Sample = np.asarray(Time) * self.Rate
+        Seg = np.maximum(np.searchsorted(self.SegTime, Sample, 'right')-1, 0)
+
+        # Rounding absorbs the float error of converting samples to seconds and back
+        Offset = np.clip(np.ceil(np.round(Sample - self.SegTime[Seg], 6)), 0, None).astype('int64')
+        return(np.minimum(self.SegIndex[Seg] + Offset, self.SegEnd[Seg]))
+
+
+def ReadChannels(Block, Channels):
+    """
+    Read Channels (int or 1d int array) from the last axis of Block, taking
+    runs of consecutive channels as slices rather than gathers.
+    """
+    if np.ndim(Channels) == 0: return(Block[..., int(Channels)])
+    if not len(Channels): return(Block[..., Channels])
+
+    Starts = np.concatenate(([0], np.flatnonzero(np.diff(Channels) != 1)+1))
+    if len(Starts) == 1: return(Block[..., Channels[0]:Channels[-1]+1])
+    if len(Starts) > len(Channels)//2: return(Block[..., Channels])
+
+    Ends = np.concatenate((Starts[1:], [len(Channels)]))
+    Out = np.empty(Block.shape[:-1]+(len(Channels),), dtype=Block.dtype)
+    for S, E in zip(Starts, Ends):
+        Out[..., S:E] = Block[..., Channels[S]:Channels[E-1]+1]
+
+    return(Out)
 
 
 def ApplyChannelMap(Data, ChannelMap):
@@ -84,75 +306,248 @@ def ApplyChannelMap(Data, ChannelMap):
             print('Not enough channels in data to apply channel map. Skipping...')
             continue
 
-        Data[R] = Data[R][:,ChannelMap]
+        # Only stored as an index; applied when the data is sliced
+        if not isinstance(Rec, LazyData): Rec = LazyData(Rec)
+        Data[R] = Rec.Map(ChannelMap)
 
     return(Data)
 
 
 def BitsToVolts(Data, ChInfo, Unit):
     print('Converting to uV... ', end='')
-    Data = {R: Rec.astype('float32') for R, Rec in Data.items()}
 
     if Unit.lower() == 'uv': U = 1
     elif Unit.lower() == 'mv': U = 10**-3
 
-    for R in Data.keys():
-        for C in range(len(ChInfo)):
-            Data[R][:,C] = Data[R][:,C] * ChInfo[C]['bit_volts'] * U
-            if 'ADC' in ChInfo[C]['channel_name']: Data[R][:,C] *= 10**6
+    Scale = np.array([Ch['bit_volts'] * U for Ch in ChInfo], dtype='float64')
+    for C in range(len(ChInfo)):
+        if 'ADC' in ChInfo[C]['channel_name']: Scale[C] *= 10**6
+
+    # Conversion is done by LazyData only on the samples that are accessed
+    Data = {R: LazyData(Rec, Scale) for R, Rec in Data.items()}
 
     return(Data)
 
 
-def Load(Folder, Processor=None, Experiment=None, Recording=None, Unit='uV', ChannelMap=[]):
-    Files = sorted(glob(Folder+'/**/*.dat', recursive=True))
-    InfoFiles = sorted(glob(Folder+'/*/*/structure.oebin'))
+def FileStat(File):
+    St = os.stat(File)
+    return([St.st_mtime_ns, St.st_size])
 
 
-    Data, Rate = {}, {}
-    for F,File in enumerate(Files):
-        File = File.replace('\\', '/') # Replace windows file delims
-        Exp, Rec, _, Proc = File.split('/')[-5:-1]
-        Exp = str(int(Exp[10:])-1)
-        Rec = str(int(Rec[9:])-1)
-        Proc = Proc.split('.')[0].split('-')[-1]
-        if '_' in Proc: Proc = Proc.split('_')[0]
+def IndexPaths(Folder, Name=IndexFile):
+    """
+    Return the sidecar file Name inside Folder and its fallback in
+    IndexCacheDir, used when Folder is not writable.
+    """
+    Key = hashlib.sha1(os.path.abspath(Folder).encode()).hexdigest()
+    if Name != IndexFile: Key += Name
+    return([os.path.join(Folder, Name), os.path.join(IndexCacheDir, Key+'.json')])
 
-        if Proc not in Data.keys(): Data[Proc], Rate[Proc] = {}, {}
 
-        if Experiment:
-            if int(Exp) != Experiment-1: continue
+def ReadIndex(Folder, Name=IndexFile, Version=IndexVersion):
+    for File in IndexPaths(Folder, Name):
+        try:
+            with open(File) as F: Index = json.load(F)
+        except (OSError, ValueError):
+            continue
 
-        if Recording:
-            if int(Rec) != Recording-1: continue
+        if Index.get('Version') == Version: return(Index)
 
-        if Processor:
-            if Proc != Processor: continue
+    return({})
 
-        print('Loading recording', int(Rec)+1, '...')
-        if Exp not in Data[Proc]: Data[Proc][Exp] = {}
-        Data[Proc][Exp][Rec] = np.memmap(File, dtype='int16', mode='c')
 
+def WriteIndex(Folder, Index, Name=IndexFile):
+    for File in IndexPaths(Folder, Name):
+        try:
+            os.makedirs(os.path.dirname(File), exist_ok=True)
+            with open(File+'.tmp', 'w') as F: json.dump(Index, F)
+            os.replace(File+'.tmp', File)
+            return(File)
+        except OSError:
+            continue
 
-        Info = literal_eval(open(InfoFiles[F]).read())
-        ProcIndex = [Info['continuous'].index(_) for _ in Info['continuous']
-                     if str(_['source_processor_id']) == Proc][0] # Changed to source_processor_id from recorded_processor_id
+    print('Could not write index for', Folder)
+    return(None)
+
+
+def FolderProc(FolderName):
+    """
+    Return the processor number from an oebin folder_name, for example '109'
+    for 'Channel_Map-109_100.0/' or '100' for 'Rhythm_FPGA-100.0/TTL_1/'.
+    """
+    Stream = FolderName.replace('\\', '/').strip('/')
+    Proc = Stream.split('/')[0].split('.')[0].split('-')[-1]
+    if '_' in Proc: Proc = Proc.split('_')[0]
+
+    return(Stream, Proc)
+
+
+def ParseOebin(Folder, RecDir):
+    """
+    Read the continuous, events and spikes streams described in
+    RecDir/structure.oebin. Each continuous stream is paired with its own
+    .dat file through its folder_name.
+    """
+    with open(os.path.join(Folder, RecDir, 'structure.oebin')) as F: Info = json.load(F)
+
+    ExpDir, RD = RecDir.split('/')
+    Exp = str(int(ExpDir[10:])-1)
+    Rec = str(int(RD[9:])-1)
+
+    Events, Spikes = [], []
+    for Kind, Entries in (('events', Events), ('spikes', Spikes)):
+        for Entry in Info.get(Kind, []):
+            Stream, Proc = FolderProc(Entry['folder_name'])
+            Entries.append({
+                'Processor': Proc, 'Experiment': Exp, 'Recording': Rec,
+                'Stream': Stream,
+                'Rate': Entry.get('sample_rate'),
+                'Folder': '/'.join([RecDir, Kind, Stream]),
+            })
+
+    Streams = []
+    for Cont in Info['continuous']:
+        Stream, Proc = FolderProc(Cont['folder_name'])
+
+        StreamDir = '/'.join([RecDir, 'continuous', Stream])
+        Streams.append({
+            'Processor': Proc, 'Experiment': Exp, 'Recording': Rec,
+            'Stream': Stream,
+            'ChNo': Cont['num_channels'],
+            'DType': 'int16',
+            'Rate': Cont['sample_rate'],
+            'BitVolts': [Ch['bit_volts'] for Ch in Cont['channels']],
+            'ChNames': [Ch['channel_name'] for Ch in Cont['channels']],
+            'DatFile': StreamDir+'/continuous.dat',
+            'TimestampsFile': StreamDir+'/timestamps.npy',
+        })
+
+    return(Streams, Events, Spikes)
+
+
+def GetIndex(Folder, Save=True):
+    """
+    Return the index of all continuous streams in the session Folder.
+
+    The index is stored as a json sidecar (IndexFile) in Folder, or in
+    IndexCacheDir if Folder is not writable. Folder itself is listed on
+    every call, as writing sidecars into it changes its mtime, while the
+    experiment and recording folders and each structure.oebin and .dat file
+    are validated against their mtimes. Only the changed parts are rebuilt,
+    and the sidecar is only rewritten when something changed, so unchanged
+    sessions are loaded without walking the filesystem.
+
+    Returns:
+        Index: dict
+            Dictionary with keys 'Dirs', with the cached folder listings,
+            and 'Recordings', with the continuous streams ('Streams'),
+            events and spikes of each recording folder. Each continuous
+            stream holds its processor, experiment, recording, number of
+            channels, dtype, sample rate, bit_volts, channel names and file
+            paths relative to Folder.
+    """
+    Old = ReadIndex(Folder)
+    OldDirs, OldRecs = Old.get('Dirs', {}), Old.get('Recordings', {})
+    Index = {'Version': IndexVersion, 'Dirs': {}, 'Recordings': {}}
+
+    def ListDir(Dir, Prefix):
+        # The sidecar itself lives in Folder and changes its mtime when
+        # written, so the top level is always listed instead.
+        MTime = None if Dir == '.' else os.stat(os.path.join(Folder, Dir)).st_mtime_ns
+        if MTime is not None and Dir in OldDirs and OldDirs[Dir]['MTime'] == MTime:
+            SubDirs = OldDirs[Dir]['SubDirs']
+        else:
+            SubDirs = sorted(_.name for _ in os.scandir(os.path.join(Folder, Dir))
+                             if _.name.startswith(Prefix) and _.name[len(Prefix):].isdigit()
+                             and _.is_dir())
+
+        Index['Dirs'][Dir] = {'MTime': MTime, 'SubDirs': SubDirs}
+        return(SubDirs)
+
+    for ExpDir in ListDir('.', 'experiment'):
+        for RD in ListDir(ExpDir, 'recording'):
+            RecDir = ExpDir+'/'+RD
+            try:
+                OebinStat = FileStat(os.path.join(Folder, RecDir, 'structure.oebin'))
+            except OSError:
+                continue
+
+            if RecDir in OldRecs and OldRecs[RecDir]['OebinStat'] == OebinStat:
+                Streams, Events, Spikes = (OldRecs[RecDir][_] for _ in ('Streams', 'Events', 'Spikes'))
+            else:
+                Streams, Events, Spikes = ParseOebin(Folder, RecDir)
+
+            for Stream in Streams:
+                try:
+                    Stream['DatStat'] = FileStat(os.path.join(Folder, Stream['DatFile']))
+                except OSError:
+                    Stream['DatStat'] = None
+
+            Index['Recordings'][RecDir] = {'OebinStat': OebinStat, 'Streams': Streams,
+                                           'Events': Events, 'Spikes': Spikes}
+
+    if Save and Index != Old: WriteIndex(Folder, Index)
+
+    return(Index)
+
+
+def Plan(Index, Processor=None, Experiment=None, Recording=None, Kind='Streams'):
+    """
+    Resolve the Processor, Experiment and Recording filters (same as in
+    Load) against the session Index, returning only the matching entries of
+    Kind ('Streams', 'Events' or 'Spikes'), sorted by processor, experiment
+    and recording. No data file is opened.
+    """
+    Streams = [Stream for Rec in Index['Recordings'].values() for Stream in Rec[Kind]
+               if Stream.get('DatStat', True) is not None]
+
+    if Processor: Streams = [_ for _ in Streams if _['Processor'] == Processor]
+    if Experiment: Streams = [_ for _ in Streams if int(_['Experiment']) == Experiment-1]
+    if Recording: Streams = [_ for _ in Streams if int(_['Recording']) == Recording-1]
+
+    return(sorted(Streams, key=lambda x: (x['Processor'], int(x['Experiment']), int(x['Recording']))))
+
+
+def Load(Folder, Processor=None, Experiment=None, Recording=None, Unit='uV', ChannelMap=[], UseIndex=True,
+         Start=None, Stop=None, TimeUnit='s'):
+    Index = GetIndex(Folder, Save=UseIndex)
+    Streams = Plan(Index, Processor, Experiment, Recording)
+
+    Data, Rate, ChInfo = {}, {}, {}
+    for Stream in Streams:
+        Proc, Exp, Rec = Stream['Processor'], Stream['Experiment'], Stream['Recording']
+        if Proc not in Data.keys(): Data[Proc], Rate[Proc] = {}, {}
 
-        ChNo = Info['continuous'][ProcIndex]['num_channels']
-        if Data[Proc][Exp][Rec].shape[0]%ChNo:
+        ChNo = Stream['ChNo']
+        SampleBytes = np.dtype(Stream['DType']).itemsize * ChNo
+        if Stream['DatStat'][1]%SampleBytes:
             print('Rec', Rec, 'is broken')
-            del(Data[Proc][Exp][Rec])
             continue
 
-        SamplesPerCh = Data[Proc][Exp][Rec].shape[0]//ChNo
-        Data[Proc][Exp][Rec] = Data[Proc][Exp][Rec].reshape((SamplesPerCh, ChNo))
-        Rate[Proc][Exp] = Info['continuous'][ProcIndex]['sample_rate']
+        SamplesPerCh = Stream['DatStat'][1]//SampleBytes
+        Window = slice(*(
+            None if T is None else int(round(T*Stream['Rate'])) if TimeUnit.lower() == 's' else int(T)
+            for T in (Start, Stop)
+        )).indices(SamplesPerCh)
+        Samples = max(Window[1]-Window[0], 0)
+
+        print('Loading recording', int(Rec)+1, '...')
+        if Exp not in Data[Proc]: Data[Proc][Exp] = {}
+        if Samples:
+            # Map only the requested time window
+            Data[Proc][Exp][Rec] = np.memmap(os.path.join(Folder, Stream['DatFile']), dtype=Stream['DType'],
+                                             mode='c', offset=Window[0]*SampleBytes, shape=(Samples, ChNo))
+        else:
+            Data[Proc][Exp][Rec] = np.zeros((0, ChNo), dtype=Stream['DType'])
+
+        Rate[Proc][Exp] = Stream['Rate']
+        ChInfo[Proc] = [{'bit_volts': B, 'channel_name': N}
+                        for B, N in zip(Stream['BitVolts'], Stream['ChNames'])]
 
     for Proc in Data.keys():
         for Exp in Data[Proc].keys():
             if Unit.lower() in ['uv', 'mv']:
-                ChInfo = Info['continuous'][ProcIndex]['channels']
-                Data[Proc][Exp] = BitsToVolts(Data[Proc][Exp], ChInfo, Unit)
+                Data[Proc][Exp] = BitsToVolts(Data[Proc][Exp], ChInfo[Proc], Unit)
 
             if ChannelMap: Data[Proc][Exp] = ApplyChannelMap(Data[Proc][Exp], ChannelMap)
 
@@ -160,3 +555,111 @@ def Load(Folder, Processor=None, Experiment=None, Recording=None, Unit='uV', Cha
 
     return(Data, Rate)
 
+
+def LoadNpyFolder(Folder, Files):
+    """
+    Memory-map each existing Files (without the .npy extension) in Folder.
+    Arrays that cannot be mapped, such as TEXT events, are skipped.
+    """
+    Arrays = {}
+    for File in Files:
+        Path = os.path.join(Folder, File+'.npy')
+        if not os.path.isfile(Path): continue
+
+        try:
+            Arrays[File] = np.load(Path, mmap_mode='r')
+        except ValueError:
+            print('Could not map', Path, ', skipping...')
+
+    return(Arrays)
+
+
+def LoadEntries(Folder, Kind, Files, Processor, Experiment, Recording, UseIndex):
+    Index = GetIndex(Folder, Save=UseIndex)
+
+    Data = {}
+    for Entry in Plan(Index, Processor, Experiment, Recording, Kind):
+        Proc, Exp, Rec = Entry['Processor'], Entry['Experiment'], Entry['Recording']
+        Group = Entry['Stream'].split('/')[-1]
+
+        Data.setdefault(Proc, {}).setdefault(Exp, {}).setdefault(Rec, {})
+        Data[Proc][Exp][Rec][Group] = LoadNpyFolder(os.path.join(Folder, Entry['Folder']), Files)
+
+    return(Data)
+
+
+def LoadEvents(Folder, Processor=None, Experiment=None, Recording=None, UseIndex=True):
+    """
+    Load events recorded in Binary format as read-only memmaps of their .npy
+    files, so no data is copied until it is used.
+
+    Parameters are the same as in Load.
+
+    Returns:
+        Events: dict
+            Dictionary in the structure Events[Processor][Experiment][Recording][Group],
+            where Group is the event folder name (e.g. 'TTL_1'). Each group
+            is a dict with the available arrays among 'timestamps',
+            'channels', 'channel_states', 'full_words', 'data_array',
+            'text' and 'metadata'.
+
+    Example:
+        Events = Binary.LoadEvents(Folder, Processor='100')
+        TTLs = Events['100']['0']['0']['TTL_1']
+        Rising = TTLs['timestamps'][TTLs['channel_states'] > 0]
+    """
+    Files = ['timestamps', 'channels', 'channel_states', 'full_words', 'data_array', 'text', 'metadata']
+    return(LoadEntries(Folder, 'Events', Files, Processor, Experiment, Recording, UseIndex))
+
+
+def LoadSpikes(Folder, Processor=None, Experiment=None, Recording=None, UseIndex=True):
+    """
+    Load spikes recorded in Binary format as read-only memmaps of their .npy
+    files, so no data is copied until it is used.
+
+    Parameters are the same as in Load.
+
+    Returns:
+        Spikes: dict
+            Dictionary in the structure Spikes[Processor][Experiment][Recording][Group],
+            where Group is the spike folder name (e.g. 'spike_group_1').
+            Each group is a dict with the available arrays among
+            'spike_times', 'spike_clusters', 'spike_electrode_indices',
+            'spike_waveforms' and 'metadata'.
+    """
+    Files = ['spike_times', 'spike_clusters', 'spike_electrode_indices', 'spike_waveforms', 'metadata']
+    return(LoadEntries(Folder, 'Spikes', Files, Processor, Experiment, Recording, UseIndex))
+
+
+def LoadTimestamps(Folder, Processor=None, Experiment=None, Recording=None, UseIndex=True):
+    """
+    Load the timestamps of continuous streams as Timestamps objects, which
+    convert between sample indices and times without building full-length
+    time arrays.
+
+    Parameters are the same as in Load.
+
+    Returns:
+        TS: dict
+            Dictionary in the structure TS[Processor][Experiment][Recording].
+
+    Example:
+        Data, Rate = Binary.Load(Folder, Processor='100')
+        TS = Binary.LoadTimestamps(Folder, Processor='100')
+        Events = Binary.LoadEvents(Folder, Processor='100')
+
+        T = TS['100']['0']['0']
+        TTLs = Events['100']['0']['0']['TTL_1']
+        EventIndexes = T.time_to_index(TTLs['timestamps']/Rate['100']['0'])
+    """
+    Index = GetIndex(Folder, Save=UseIndex)
+
+    TS = {}
+    for Stream in Plan(Index, Processor, Experiment, Recording):
+        File = os.path.join(Folder, Stream['TimestampsFile'])
+        if not os.path.isfile(File): continue
+
+        Proc, Exp, Rec = Stream['Processor'], Stream['Experiment'], Stream['Recording']
+        TS.setdefault(Proc, {}).setdefault(Exp, {})[Rec] = Timestamps(File, Stream['Rate'])
+
+    return(TS)
@@ -16,6 +16,9 @@ Examples:
     # load all datasets
     Raw = Kwik.load('experiment1_100.raw.kwd', 'all')
     
+    # write a compressed, chunked .kwd
+    Kwik.write('archive.raw.kwd', data, sample_rate=30000.0, compression='gzip', shuffle=True)
+    
     # load spikes and events
     Events = Kwik.load('experiment1.kwe')
     Spks = Kwik.load('experiment1.kwx')
@@ -23,14 +26,215 @@ Examples:
     # load all files in a folder:
     Raw, Events, Spks, Files = load_all_files(folder)
     
+    # timestamps are computed on access
+    Raw['timestamps'][:1000]
+    Raw['timestamps'].time_to_index(12.5)
+    
+    # keep files open across calls in a bounded pool, with a larger HDF5
+    # chunk cache
+    with Kwik.KwikSession(max_open=16, rdcc_nbytes=64 * 2**20):
+        Raw = Kwik.load('experiment1_100.raw.kwd')
+    
 """
 
 import glob
 import h5py
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 import numpy as np
 
+
+class KwikSession(object):
+    """
+    LRU pool of open HDF5 file handles, shared by the module functions
+    (load, convert, get_edge_index, get_experiment_start_time) while the
+    session is active.
+    
+    Files are opened read-only on first use and kept open, so repeated
+    queries on the same file skip the open and metadata cost. If more than
+    max_open files are open (None for no limit), the least recently used
+    one is closed; datasets previously returned by load() for that file
+    become invalid.
+    
+    Outside a session nothing is pooled: load() returns datasets of a
+    handle that h5py closes once they are garbage collected, and the other
+    functions close their file before returning.
+    
+    rdcc_nbytes, rdcc_nslots and rdcc_w0 set the HDF5 chunk cache of the
+    files opened by the session (see h5py.File); a larger rdcc_nbytes
+    speeds up large sequential reads.
+    
+    Used as a context manager, the session is active in the current thread
+    until exit, where it closes all its files:
+    
+        with Kwik.KwikSession(max_open=16, rdcc_nbytes=64 * 2**20):
+            for filename in filenames:
+                times = Kwik.get_rising_edge_times(filename, 1)
+    """
+    
+    def __init__(self, max_open=64, rdcc_nbytes=None, rdcc_nslots=None,
+                 rdcc_w0=None):
+        self.max_open = max_open
+        self.cache_options = {key: value for key, value in
+                              (('rdcc_nbytes', rdcc_nbytes),
+                               ('rdcc_nslots', rdcc_nslots),
+                               ('rdcc_w0', rdcc_w0)) if value is not None}
+        self._files = OrderedDict()
+        self._lock = threading.RLock()
+    
+    def open(self, filename):
+        """Return an open read-only h5py.File for filename."""
+        key = os.path.abspath(filename)
+        with self._lock:
+            f = self._files.get(key)
+            if f is not None and f.id.valid:
+                self._files.move_to_end(key)
+                return f
+        
+        # open outside the pool lock, so that opening one file does not
+        # block lookups of files that are already open
+        f = h5py.File(filename, 'r', **self.cache_options)
+        
+        with self._lock:
+            # another thread may have opened the same file meanwhile
+            existing = self._files.get(key)
+            if existing is not None and existing.id.valid:
+                f.close()
+                self._files.move_to_end(key)
+                return existing
+            
+            self._files[key] = f
+            while self.max_open is not None and len(self._files) > self.max_open:
+                _, oldest = self._files.popitem(last=False)
+                oldest.close()
+            
+            return f
+    
+    def release(self, filename):
+        """Close filename if it is open in this session."""
+        with self._lock:
+            f = self._files.pop(os.path.abspath(filename), None)
+            if f is not None:
+                f.close()
+    
+    def close(self):
+        """Close all files opened by this session."""
+        with self._lock:
+            while self._files:
+                _, f = self._files.popitem()
+                f.close()
+    
+    def __enter__(self):
+        _active_sessions().append(self)
+        return self
+    
+    def __exit__(self, *exc):
+        _active_sessions().remove(self)
+        self.close()
+
+
+# sessions entered by each thread, innermost last
+_local = threading.local()
+
+def _active_sessions():
+    if not hasattr(_local, 'sessions'):
+        _local.sessions = []
+    return _local.sessions
+
+def _open(filename):
+    # handle for load(): pooled in the innermost active KwikSession, if any,
+    # otherwise closed by h5py once the returned datasets are collected
+    sessions = _active_sessions()
+    if sessions:
+        return sessions[-1].open(filename)
+    return h5py.File(filename, 'r')
+
+@contextmanager
+def _reading(filename):
+    # handle for functions that only return numpy values: pooled in the
+    # innermost active KwikSession, if any, otherwise closed on exit
+    sessions = _active_sessions()
+    if sessions:
+        yield sessions[-1].open(filename)
+    else:
+        with h5py.File(filename, 'r') as f:
+            yield f
+
+
+class LazyTimestamps(object):
+    """
+    Timestamps of a .kwd recording, (arange(n_samples) + start_time) / sample_rate,
+    computed only for the indices that are accessed.
+    
+    Supports len(), indexing with ints, slices and index arrays, np.asarray()
+    and time -> index lookups without allocating the full array.
+    """
+    
+    def __init__(self, n_samples, start_time, sample_rate):
+        self.n_samples = int(n_samples)
+        self.start_time = start_time
+        self.sample_rate = sample_rate
+    
+    def __len__(self):
+        return self.n_samples
+    
+    @property
+    def shape(self):
+        return (self.n_samples,)
+    
+    @property
+    def dtype(self):
+        return np.dtype(np.float64)
+    
+    def __repr__(self):
+        return 'LazyTimestamps(n_samples=%d, start_time=%s, sample_rate=%s)' % (
+            self.n_samples, self.start_time, self.sample_rate)
+    
+    def __array__(self, dtype=None, copy=None):
+        times = self[:]
+        return times if dtype is None else times.astype(dtype)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            index = np.arange(*index.indices(self.n_samples))
+        else:
+            index = np.asarray(index)
+            index = np.where(index < 0, index + self.n_samples, index)
+            if index.size and (index.min() < 0 or index.max() >= self.n_samples):
+                raise IndexError('index out of bounds for %d timestamps' % self.n_samples)
+        
+        return (index + self.start_time) / self.sample_rate
+    
+    def searchsorted(self, times, side='left'):
+        """Same as np.searchsorted(np.asarray(self), times, side), computed
+        directly from start_time and sample_rate."""
+        position = np.asarray(times) * self.sample_rate - self.start_time
+        if side == 'left':
+            index = np.ceil(np.round(position, 6))
+        else:
+            index = np.floor(np.round(position, 6)) + 1
+        
+        return np.clip(index, 0, self.n_samples).astype(np.int64)
+    
+    def time_to_index(self, times):
+        """Index of the first sample at or after times (in seconds)."""
+        return self.searchsorted(times, 'left')
+    
+    def samples_to_index(self, samples):
+        """Convert event sample numbers (e.g. time_samples in .kwe files)
+        to indices into this recording."""
+        return np.asarray(samples) - self.start_time
+    
+    def samples_to_times(self, samples):
+        """Convert event sample numbers to times in seconds, on the same
+        time base as the timestamps."""
+        return np.asarray(samples) / self.sample_rate
+
 def load(filename, dataset=0):
-    f = h5py.File(filename, 'r')
+    f = _open(filename)
     
     if filename[-4:] == '.kwd':
         data = {}
@@ -60,10 +264,10 @@ def load(filename, dataset=0):
                                              for Rec in f['recordings'].keys()}
                 
             
-            data['timestamps'] = {Rec: ((
-                                        np.arange(0,data['data'][Rec].shape[0])
-                                        + data['info'][Rec]['start_time'])
-                                       / data['info'][Rec]['sample_rate'])
+            data['timestamps'] = {Rec: LazyTimestamps(
+                                        data['data'][Rec].shape[0],
+                                        data['info'][Rec]['start_time'],
+                                        data['info'][Rec]['sample_rate'])
                                        for Rec in f['recordings']}
         
         else:
@@ -72,9 +276,9 @@ def load(filename, dataset=0):
                                          ['application_data']\
                                          ['channel_bit_volts']
             data['data'] = f['recordings'][str(dataset)]['data']
-            data['timestamps'] = ((np.arange(0,data['data'].shape[0])
-                                   + data['info']['start_time'])
-                                  / data['info']['sample_rate'])
+            data['timestamps'] = LazyTimestamps(data['data'].shape[0],
+                                                data['info']['start_time'],
+                                                data['info']['sample_rate'])
         return(data)
     
     elif filename[-4:] == '.kwe':
@@ -101,6 +305,12 @@ def load_all_files(folder, dataset='all'):
     """
     Load kwd, kwe, kwik and/or kwx files in a folder.
     
+    Only metadata is read up front: data, bit volts and events are returned
+    as h5py datasets and timestamps as LazyTimestamps, so they are read on
+    demand. Inside a KwikSession, its max_open should be at least the
+    number of files in the folder, or datasets of the first files become
+    invalid.
+    
     Returns:
         Raw: dict containing info, timestamps and raw data from one or all 
              datasets
@@ -145,68 +355,302 @@ def load_all_files(folder, dataset='all'):
     return(Raw, Events, Spks, Files)
 
 
-def convert(filename, filetype='dat', dataset=0):
-
-    f = h5py.File(filename, 'r')
+def convert(filename, filetype='dat', dataset=0, order=None, scale=False,
+            buffer_bytes=64 * 2**20, verbose=True):
+    """
+    Stream recordings from a .kwd file into a flat binary file.
+    
+    Data is read in blocks aligned to the HDF5 chunk layout into a
+    preallocated buffer of about buffer_bytes, and written sequentially, so
+    memory use does not depend on the size of the recording.
+    
+    Args:
+        filename: .kwd file to convert. The output is written next to it,
+            with the extension replaced by filetype.
+        filetype: only 'dat' is supported.
+        dataset: recording to convert, or 'all' to write every recording,
+            in order, into the same file.
+        order: optional list of channel indices, the order in which
+            channels are written.
+        scale: if True, multiply by channel_bit_volts and write float32
+            instead of int16.
+        buffer_bytes: approximate size of the read/write buffer.
+        verbose: print the throughput.
+    """
     fnameout = filename[:-3] + filetype
 
-    if filetype == 'dat':    
-        data = f['recordings'][str(dataset)]['data'][:,:]
-        data.tofile(fnameout)
+    if filetype == 'dat':
+        t0 = time.time()
+        n_bytes = 0
+        with _reading(filename) as f, open(fnameout, 'wb') as out:
+            if dataset == 'all':
+                datasets = sorted(f['recordings'].keys(), key=int)
+            else:
+                datasets = [str(dataset)]
+            
+            for rec in datasets:
+                n_bytes += _stream_recording(f['recordings'][rec], out, order,
+                                             scale, buffer_bytes)
+        
+        if verbose:
+            elapsed = max(time.time() - t0, 1e-9)
+            print('Wrote %.1f MB to %s in %.2f s (%.1f MB/s)' % (
+                n_bytes / 1e6, fnameout, elapsed, n_bytes / 1e6 / elapsed))
+
+
+def _stream_recording(recording, out, order=None, scale=False,
+                      buffer_bytes=64 * 2**20):
+    # Write one recording group to the open file `out`, block by block.
+    # Returns the number of bytes written.
+    data = recording['data']
+    n_samples, n_channels = data.shape
+    if order is None:
+        order = np.arange(n_channels)
+    order = np.asarray(order)
+    
+    # Blocks span whole HDF5 chunks along time, with all channels
+    row_bytes = n_channels * data.dtype.itemsize
+    block_rows = max(buffer_bytes // row_bytes, 1)
+    if data.chunks is not None:
+        chunk_rows = data.chunks[0]
+        block_rows = max(block_rows // chunk_rows, 1) * chunk_rows
+    block_rows = min(block_rows, max(n_samples, 1))
+    
+    buf = np.empty((block_rows, n_channels), dtype=data.dtype)
+    if scale:
+        if 'channel_bit_volts' in recording.get('application_data', {}):
+            bit_volts = recording['application_data']['channel_bit_volts'][:]
+        else:
+            # Old OE versions do not have channel_bit_volts info.
+            bit_volts = np.full(n_channels, 0.195)
+        bit_volts = np.asarray(bit_volts, dtype=np.float32)[order]
+        out_buf = np.empty((block_rows, len(order)), dtype=np.float32)
+    else:
+        out_buf = np.empty((block_rows, len(order)), dtype=data.dtype)
+    
+    n_bytes = 0
+    for start in range(0, n_samples, block_rows):
+        stop = min(start + block_rows, n_samples)
+        n = stop - start
+        data.read_direct(buf, np.s_[start:stop], np.s_[0:n])
+        
+        block = out_buf[:n]
+        if scale:
+            np.multiply(buf[:n, order], bit_volts, out=block)
+        else:
+            block[...] = buf[:n, order]
+        
+        block.tofile(out)
+        n_bytes += block.nbytes
+    
+    return n_bytes
     
 
-def write(filename, dataset=0, bit_depth=1.0, sample_rate=25000.0):
+def write(filename, dataset=0, bit_depth=1.0, sample_rate=25000.0,
+          recording=0, start_time=None, channel_bit_volts=None,
+          compression=None, compression_opts=None, shuffle=False,
+          chunk_bytes=2**19, mode='w-'):
+    """
+    Write int16 data to a .kwd file as chunked, optionally compressed,
+    HDF5 datasets.
     
-    f = h5py.File(filename, 'w-')
-    f.attrs['kwik_version'] = 2
+    Args:
+        filename: .kwd file to write.
+        dataset: data of shape (n_samples, n_channels), either an array
+            (including np.memmap), or an iterator yielding blocks of shape
+            (n, n_channels), which are appended as they come. A list of
+            those writes one recording per element.
+        bit_depth, sample_rate: stored as attributes of every recording.
+        recording: number of the (first) recording to write. If it already
+            exists (mode='a'), the data is appended to it.
+        start_time: start time of each new recording, in samples. If None,
+            a recording starts where the previous recording in the file
+            ends. A list gives one value per recording.
+        channel_bit_volts: per-channel scaling, stored in
+            application_data/channel_bit_volts as read by load(). Defaults
+            to bit_depth for every channel.
+        compression: None, 'gzip' or 'lzf'; lossless filters built into h5py.
+        compression_opts: e.g. the gzip level (0-9).
+        shuffle: apply the HDF5 shuffle filter, which usually improves
+            compression of int16 data.
+        chunk_bytes: approximate size of each HDF5 chunk. Chunks span all
+            channels, so reading a time window touches as few chunks as
+            possible.
+        mode: h5py file mode, 'w-' (default) to create a new file or 'a' to
+            add recordings or samples to an existing one.
+    """
+    if isinstance(dataset, (list, tuple)):
+        recordings = dataset
+    else:
+        recordings = [dataset]
     
-    grp = f.create_group("/recordings/0")
+    if start_time is None or np.isscalar(start_time):
+        start_time = [start_time] * len(recordings)
     
-    dset = grp.create_dataset("data", dataset.shape, dtype='i16')
-    dset[:,:] = dataset
+    # a read-only handle kept by a session would block writing
+    for session in _active_sessions():
+        session.release(filename)
+    
+    f = h5py.File(filename, mode)
+    f.attrs['kwik_version'] = 2
     
-    grp.attrs['start_time'] = 0.0
-    grp.attrs['start_sample'] = 0
-    grp.attrs['sample_rate'] = sample_rate
-    grp.attrs['bit_depth'] = bit_depth
+    for i, data in enumerate(recordings):
+        name = '/recordings/' + str(recording + i)
+        
+        if name in f:
+            dset = f[name]['data']
+        else:
+            grp = f.create_group(name)
+            
+            if start_time[i] is None:
+                start_time[i] = _next_start_time(f, recording + i)
+            grp.attrs['start_time'] = float(start_time[i])
+            grp.attrs['start_sample'] = int(start_time[i])
+            grp.attrs['sample_rate'] = sample_rate
+            grp.attrs['bit_depth'] = bit_depth
+            dset = None
+        
+        if isinstance(data, np.ndarray):
+            rows = max(chunk_bytes // max(data.shape[1] * 2, 1), 1)
+            blocks = (data[start:start + rows]
+                      for start in range(0, data.shape[0], rows))
+        else:
+            blocks = iter(data)
+        
+        for block in blocks:
+            block = np.asarray(block, dtype=np.int16)
+            
+            if dset is None:
+                n_channels = block.shape[1]
+                rows = max(chunk_bytes // (n_channels * 2), 1)
+                dset = grp.create_dataset("data", (0, n_channels), dtype=np.int16,
+                                          maxshape=(None, n_channels),
+                                          chunks=(rows, n_channels),
+                                          compression=compression,
+                                          compression_opts=compression_opts,
+                                          shuffle=shuffle)
+                
+                if channel_bit_volts is None:
+                    bit_volts = [bit_depth] * n_channels
+                else:
+                    bit_volts = channel_bit_volts
+                grp.create_dataset('application_data/channel_bit_volts',
+                                   data=np.asarray(bit_volts, dtype=np.float32))
+            
+            n = dset.shape[0]
+            dset.resize(n + block.shape[0], axis=0)
+            dset[n:] = block
     
     f.close()
 
 
+def _next_start_time(f, recording):
+    # start time of `recording`: where the previous recording in the file ends
+    previous = [int(r) for r in f['recordings'] 
+                if int(r) < recording and 'data' in f['recordings'][r]]
+    if not previous:
+        return 0.0
+    
+    grp = f['recordings'][str(max(previous))]
+    return grp.attrs['start_time'] + grp['data'].shape[0]
+
+
 def get_sample_rate(f):
     return f['recordings']['0'].attrs['sample_rate'] 
 
 
-def get_edge_times(f, TTLchan, rising=True):
+class EdgeIndex(object):
+    """
+    TTL edge times of all channels in a .kwe/.kwik file.
+    
+    The TTL event table is read once, and its events are sorted and grouped
+    by channel and polarity (eventID 1 = rising, 0 = falling), so each
+    query afterwards is a dictionary lookup returning a view.
+    
+    Example:
+        edges = Kwik.get_edge_index('experiment1.kwe')
+        edges.rising(3)          # rising edge times (s) of TTL channel 3
+        edges.to_dict()          # {(channel, rising): times}
+    """
     
-    events_for_chan = np.where(np.squeeze(f['event_types']['TTL']['events']['user_data']['event_channels']) == TTLchan)
+    def __init__(self, f):
+        events = f['event_types']['TTL']['events']
+        channels = np.atleast_1d(np.squeeze(events['user_data']['event_channels'][()]))
+        event_ids = np.atleast_1d(np.squeeze(events['user_data']['eventID'][()]))
+        samples = np.atleast_1d(np.squeeze(events['time_samples'][()]))
+        self.sample_rate = get_sample_rate(f)
+        
+        # only eventIDs 0 and 1 are edges; a stable sort keeps them in time order
+        is_edge = (event_ids == 0) | (event_ids == 1)
+        keys = channels[is_edge].astype(np.int64) * 2 + event_ids[is_edge]
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        self.times = samples[is_edge][order] / self.sample_rate
+        
+        unique_keys, starts = np.unique(keys, return_index=True)
+        stops = np.append(starts[1:], len(keys))
+        self._slices = {(int(k // 2), bool(k % 2)): slice(start, stop)
+                        for k, start, stop in zip(unique_keys, starts, stops)}
     
-    edges = np.where(np.squeeze(f['event_types']['TTL']['events']['user_data']['eventID']) == 1*rising) 
+    @property
+    def channels(self):
+        return sorted(set(channel for channel, _ in self._slices))
     
-    edges_for_chan = np.intersect1d(events_for_chan, edges)
+    def edges(self, TTLchan, rising=True):
+        return self.times[self._slices.get((TTLchan, bool(rising)), slice(0, 0))]
     
-    edge_samples = np.squeeze(f['event_types']['TTL']['events']['time_samples'][:])[edges_for_chan]
-    edge_times = edge_samples / get_sample_rate(f)
+    def rising(self, TTLchan):
+        return self.edges(TTLchan, True)
     
-    return edge_times
+    def falling(self, TTLchan):
+        return self.edges(TTLchan, False)
+    
+    def to_dict(self):
+        return {key: self.times[sl] for key, sl in self._slices.items()}
 
 
-def get_rising_edge_times(filename, TTLchan):
+_edge_indexes = {}
+
+def get_edge_index(filename):
+    """
+    Return the EdgeIndex of a .kwe/.kwik file, cached until the file
+    changes on disk.
+    """
+    stat = os.stat(filename)
+    key = os.path.abspath(filename)
+    version = (stat.st_mtime_ns, stat.st_size)
     
-    f = h5py.File(filename, 'r')
+    if key not in _edge_indexes or _edge_indexes[key][0] != version:
+        with _reading(filename) as f:
+            _edge_indexes[key] = (version, EdgeIndex(f))
     
-    return get_edge_times(f, TTLchan, True)
+    return _edge_indexes[key][1]
 
 
-def get_falling_edge_times(filename, TTLchan):
+def get_all_edge_times(filename):
+    """
+    Return a dict {(TTLchan, rising): edge times} for every TTL channel,
+    reading the event table only once.
+    """
+    return get_edge_index(filename).to_dict()
+
+
+def get_edge_times(f, TTLchan, rising=True):
+    
+    return get_edge_index(f.filename).edges(TTLchan, rising)
+
+
+def get_rising_edge_times(filename, TTLchan):
     
-    f = h5py.File(filename, 'r')
+    return get_edge_index(filename).rising(TTLchan)
+
+
+def get_falling_edge_times(filename, TTLchan):
     
-    return get_edge_times(f, TTLchan, False)  
+    return get_edge_index(filename).falling(TTLchan)
 
 
 def get_experiment_start_time(filename):
     
-    f = h5py.File(filename, 'r')
-    
-    return f['event_types']['Messages']['events']['time_samples'][1]/ get_sample_rate(f)
+    with _reading(filename) as f:
+        return f['event_types']['Messages']['events']['time_samples'][1]/ get_sample_rate(f)
@@ -13,25 +13,48 @@ Usage:
 """
 
 import os
+import re
+import bisect
 import numpy as np
 import scipy.signal
 import scipy.io
 import time
-import struct
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 
 # constants
 NUM_HEADER_BYTES = 1024
 SAMPLES_PER_RECORD = 1024
 BYTES_PER_SAMPLE = 2
-RECORD_SIZE = 4 + 8 + SAMPLES_PER_RECORD * BYTES_PER_SAMPLE + 10 # size of each continuous record in bytes
+RECORD_SIZE = 4 + 8 + SAMPLES_PER_RECORD * BYTES_PER_SAMPLE + 10 # size of each continuous record in bytes, i.e. _record_dtype().itemsize
 RECORD_MARKER = np.array([0, 1, 2, 3, 4, 5, 6, 7, 8, 255])
 
+# layout of each 16-byte record in an .events file
+EVENT_DTYPE = np.dtype([('timestamps', '<i8'),
+                        ('sampleNum', '<i2'),
+                        ('eventType', '<u1'),
+                        ('nodeId', '<u1'),
+                        ('eventId', '<u1'),
+                        ('channel', '<u1'),
+                        ('recordingNumber', '<u2')])
+
 # constants for pre-allocating matrices:
 MAX_NUMBER_OF_SPIKES = int(1e6)
 MAX_NUMBER_OF_RECORDS = int(1e6)
 MAX_NUMBER_OF_EVENTS = int(1e6)
 
+# number of records decoded at once when streaming from a ContinuousMemmap
+MAX_RECORDS_PER_READ = 4096
+
+# <source>_<chprefix><channel>[_<session>].continuous, see get_folder_index
+CONTINUOUS_FILENAME = re.compile(r'^(\d+)_([A-Za-z]+)(\d+)(?:_(\d+))?\.continuous$')
+
+# header fields converted by scan_headers, and the ones that
+# get_header_from_folder requires to match across files
+HEADER_FLOAT_KEYS = ('bitVolts', 'sampleRate')
+HEADER_INT_KEYS = ('blockLength', 'bufferSize', 'header_bytes')
+HEADER_CONSISTENT_KEYS = ('bitVolts', 'blockLength', 'bufferSize', 'date_created',
+                          'description', 'format', 'header_bytes', 'sampleRate', 'version')
+
 def load(filepath, dtype = float):
 
     # redirects to code for individual file types
@@ -56,7 +79,7 @@ def loadFolder(folderpath, dtype = float, **kwargs):
     if 'channels' in kwargs.keys():
         filelist = ['100_CH'+x+'.continuous' for x in map(str,kwargs['channels'])]
     else:
-        filelist = os.listdir(folderpath)
+        filelist = sorted(os.path.basename(path) for path, size in get_folder_index(folderpath).values())
 
     t0 = time.time()
     numFiles = 0
@@ -72,38 +95,49 @@ def loadFolder(folderpath, dtype = float, **kwargs):
     return data
 
 def loadFolderToArray(folderpath, channels = 'all', chprefix = 'CH',
-                      dtype = float, session = '0', source = '100'):
+                      dtype = float, session = '0', source = '100', n_jobs = 1):
     '''Load continuous files in specified folder to a single numpy array. By default all
     CH continous files are loaded in numerical order, ordering can be specified with
-    optional channels argument which should be a list of channel numbers.'''
+    optional channels argument which should be a list of channel numbers.
 
-    if channels == 'all':
-        channels = _get_sorted_channels(folderpath, chprefix, session, source)
+    n_jobs: number of threads decoding channels in parallel. Decoding is done
+            in NumPy, which releases the GIL, and each thread writes straight
+            into its own channel of the preallocated output.
 
-    if session == '0':
-        filelist = [source + '_'+chprefix + x + '.continuous' for x in map(str,channels)]
-    else:
-        filelist = [source + '_'+chprefix + x + '_' + session + '.continuous' for x in map(str,channels)]
+    The output is allocated channel-major and returned transposed, i.e. as a
+    Fortran-ordered (n_samples, n_channels) array, so every channel is
+    decoded into contiguous memory instead of a strided column.'''
+
+    filelist = get_filelist(folderpath, channels, chprefix, session, source)
 
     t0 = time.time()
-    numFiles = 1
+    numFiles = len(filelist)
 
-    channel_1_data = loadContinuous(os.path.join(folderpath, filelist[0]), dtype)['data']
+    conts = _open_channels(folderpath, filelist, dtype)
 
-    n_samples  = len(channel_1_data)
+    n_samples  = len(conts[0])
     n_channels = len(filelist)
 
-    data_array = np.zeros([n_samples, n_channels], dtype)
-    data_array[:,0] = channel_1_data
+    data_array = np.empty([n_channels, n_samples], dtype)
 
-    for i, f in enumerate(filelist[1:]):
-            data_array[:, i + 1] = loadContinuous(os.path.join(folderpath, f), dtype)['data']
-            numFiles += 1
+    def load_channel(i):
+        # decode in blocks of records to keep the temporary buffers small
+        block = MAX_RECORDS_PER_READ * conts[i].blockLength
+        for start in range(0, n_samples, block):
+            stop = min(start + block, n_samples)
+            conts[i].read(start, stop, out=data_array[i, start:stop])
+
+    if n_jobs == 1:
+        for i in range(n_channels):
+            load_channel(i)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            list(pool.map(load_channel, range(n_channels)))
 
     print(''.join(('Avg. Load Time: ', str((time.time() - t0)/numFiles),' sec')))
     print(''.join(('Total Load Time: ', str((time.time() - t0)),' sec')))
 
-    return data_array
+    return data_array.T
 
 def loadContinuous(filepath, dtype = float):
 
@@ -119,51 +153,301 @@ def loadContinuous(filepath, dtype = float):
 
     fileLength = os.fstat(f.fileno()).st_size
 
-    # calculate number of samples
-    recordBytes = fileLength - NUM_HEADER_BYTES
-    if  recordBytes % RECORD_SIZE != 0:
-        raise Exception("File size is not consistent with a continuous file: may be corrupt")
-    nrec = recordBytes // RECORD_SIZE
-    nsamp = nrec * SAMPLES_PER_RECORD
-    # pre-allocate samples
-    samples = np.zeros(nsamp, dtype)
-    timestamps = np.zeros(nrec)
-    recordingNumbers = np.zeros(nrec)
-    indices = np.arange(0, nsamp + 1, SAMPLES_PER_RECORD, np.dtype(np.int64))
-
     header = readHeader(f)
+    blockLength = int(header.get('blockLength', SAMPLES_PER_RECORD))
+    recordDtype = _record_dtype(blockLength)
 
-    recIndices = np.arange(0, nrec)
+    nrec = _number_of_records(fileLength, blockLength)
 
-    for recordNumber in recIndices:
+    # read every record in a single call and check them all at once
+    records = np.fromfile(f, recordDtype, nrec)
+    f.close()
+    _check_records(records, blockLength)
 
-        timestamps[recordNumber] = np.fromfile(f,np.dtype('<i8'),1) # little-endian 64-bit signed integer
-        N = np.fromfile(f,np.dtype('<u2'),1)[0] # little-endian 16-bit unsigned integer
+    ch['header'] = header
+    ch['timestamps'] = records['timestamp'].astype(float)
+    ch['data'] = _decode_samples(records['samples'], dtype, float(header['bitVolts']))  # OR use downsample(samples,1), to save space
+    ch['recordingNumber'] = records['recordingNumber'].astype(float)
+    return ch
 
-        #print index
+def _record_dtype(blockLength = SAMPLES_PER_RECORD):
+    '''Structured dtype of a single .continuous record: one little-endian
+    64-bit timestamp, one little-endian 16-bit sample count (N), one big-endian
+    16-bit recording number, N big-endian 16-bit samples and a 10-byte marker.'''
+    return np.dtype([('timestamp', '<i8'),
+                     ('N', '<u2'),
+                     ('recordingNumber', '>u2'),
+                     ('samples', '>i2', (blockLength,)),
+                     ('marker', 'u1', (10,))])
+
+def _check_records(records, blockLength, firstRecord = 0, recordIndex = None):
+    '''Raise if any record has the wrong sample count or record marker.
+
+    Records are numbered from firstRecord in error messages, or by
+    recordIndex if they are not contiguous in the file.'''
+    def block(i):
+        return str(firstRecord + i if recordIndex is None else recordIndex[i])
+
+    badN = np.flatnonzero(records['N'] != blockLength)
+    if len(badN):
+        raise Exception('Found corrupted record in block ' + block(badN[0]))
+
+    badMarker = np.flatnonzero(np.any(records['marker'] != RECORD_MARKER, axis=1))
+    if len(badMarker):
+        raise Exception('Found corrupted record marker in block ' + block(badMarker[0]))
+
+def _decode_samples(samples, dtype = float, bitVolts = 1.0, out = None):
+    '''Flatten a (records, blockLength) block of big-endian samples into native
+    int16 or into float microvolts, optionally writing into `out`.'''
+    samples = samples.reshape(-1)
+    if out is None:
+        out = np.empty(samples.shape, dtype)
+
+    if dtype == float: # Convert data to float array and convert bits to voltage.
+        np.multiply(samples, bitVolts, out=out)
+    else:  # Keep data in signed 16 bit integer format.
+        out[...] = samples
+
+    return out
+
+class ContinuousMemmap:
+    '''Zero-copy view over a single .continuous file.
+
+    The file is memory-mapped with the record layout used by
+    get_number_of_records, so opening it does not read any data. Samples are
+    only byte-swapped (and scaled by bitVolts if dtype is float) for the
+    part that is indexed.
+
+    Usage:
+        cont = OpenEphys.ContinuousMemmap(pathToFile)
+        chunk = cont[30000:60000]   # samples, decoded on access
+        cont.timestamps             # one timestamp per record (lazy view)
+        cont.recordingNumber        # one recording number per record (lazy view)
+    '''
 
-        if N != SAMPLES_PER_RECORD:
-            raise Exception('Found corrupted record in block ' + str(recordNumber))
+    def __init__(self, filepath, dtype = float):
+        assert dtype in (float, np.int16), \
+          'Invalid data type specified for ContinuousMemmap, valid types are float and np.int16'
 
-        recordingNumbers[recordNumber] = (np.fromfile(f,np.dtype('>u2'),1)) # big-endian 16-bit unsigned integer
+        self.filepath = filepath
+        self.dtype = dtype
 
-        if dtype == float: # Convert data to float array and convert bits to voltage.
-            data = np.fromfile(f,np.dtype('>i2'),N) * float(header['bitVolts']) # big-endian 16-bit signed integer, multiplied by bitVolts
-        else:  # Keep data in signed 16 bit integer format.
-            data = np.fromfile(f,np.dtype('>i2'),N)  # big-endian 16-bit signed integer
-        samples[indices[recordNumber]:indices[recordNumber+1]] = data
+        with open(filepath, 'rb') as f:
+            self.header = readHeader(f)
+            fileLength = os.fstat(f.fileno()).st_size
 
-        marker = f.read(10) # dump
+        self.blockLength = int(self.header.get('blockLength', SAMPLES_PER_RECORD))
+        self.bitVolts = float(self.header['bitVolts'])
+        recordDtype = _record_dtype(self.blockLength)
+        self.nrec = _number_of_records(fileLength, self.blockLength)
 
-    #print recordNumber
-    #print index
+        if self.nrec:
+            self._records = np.memmap(filepath, recordDtype, mode='r',
+                                      offset=NUM_HEADER_BYTES, shape=(self.nrec,))
+        else:
+            self._records = np.zeros(0, recordDtype)
+
+        self.timestamps = self._records['timestamp']
+        self.recordingNumber = self._records['recordingNumber']
+
+    def __len__(self):
+        return self.nrec * self.blockLength
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    def __repr__(self):
+        return 'ContinuousMemmap(%r, %d samples)' % (self.filepath, len(self))
+
+    def __array__(self, dtype = None, copy = None):
+        data = self.read(0, len(self))
+        return data if dtype is None else data.astype(dtype)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                return self.read(start, stop)
+            key = np.arange(start, stop, step)
+
+        if np.isscalar(key):
+            index = int(key)
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError('index %d is out of bounds for %d samples' % (key, len(self)))
+            return self.read(index, index + 1)[0]
+
+        indices = np.asarray(key)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if indices.size and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError('index out of bounds for %d samples' % len(self))
+
+        recs, offsets = np.divmod(indices, self.blockLength)
+        usedRecs = np.unique(recs)
+        _check_records(self._records[usedRecs], self.blockLength, recordIndex=usedRecs)
+        samples = self._records['samples'][recs.reshape(-1), offsets.reshape(-1)]
+        return _decode_samples(samples, self.dtype, self.bitVolts).reshape(indices.shape)
+
+    def read(self, start, stop, out = None):
+        '''Decode samples [start, stop), optionally writing into `out`.'''
+        start = max(start, 0)
+        stop = min(stop, len(self))
+        if stop <= start:
+            return np.zeros(0, self.dtype) if out is None else out[:0]
+
+        firstRecord = start // self.blockLength
+        lastRecord = (stop - 1) // self.blockLength + 1
+        records = self._records[firstRecord:lastRecord]
+        _check_records(records, self.blockLength, firstRecord)
+
+        offset = firstRecord * self.blockLength
+        samples = records['samples'].reshape(-1)[start - offset:stop - offset]
+        return _decode_samples(samples, self.dtype, self.bitVolts, out)
+
+    def sample_timestamps(self, start, stop):
+        '''Return the timestamp of every sample in [start, stop).'''
+        start = max(start, 0)
+        stop = min(stop, len(self))
+        if stop <= start:
+            return np.zeros(0, np.int64)
+
+        firstRecord = start // self.blockLength
+        lastRecord = (stop - 1) // self.blockLength + 1
+        timestamps = (self.timestamps[firstRecord:lastRecord].astype(np.int64)[:, None]
+                      + np.arange(self.blockLength))
+
+        offset = firstRecord * self.blockLength
+        return timestamps.reshape(-1)[start - offset:stop - offset]
+
+    def index_of(self, timestamp):
+        '''Return the index of the first sample whose timestamp is >= timestamp.
+
+        Uses a binary search over the per-record timestamps, which are assumed
+        to be non-decreasing. Timestamps falling in a gap between two records
+        resolve to the first sample after the gap. Fractional timestamps are
+        rounded to 1e-6 samples first, so that float error in a time
+        multiplied by the sample rate (e.g. 0.017 * 30000) does not move the
+        result by one sample.'''
+        timestamp = np.round(timestamp, 6)
+        record = bisect.bisect_right(self.timestamps, timestamp) - 1
+        if record < 0:
+            return 0
+
+        offset = min(max(timestamp - int(self.timestamps[record]), 0), self.blockLength)
+        return record * self.blockLength + int(np.ceil(offset))
+
+
+def read_window(path_or_folder, t_start, t_stop, channels = 'all', dtype = float,
+                chprefix = 'CH', session = '0', source = '100'):
+    '''Read the samples with timestamps in [t_start, t_stop) seconds.
+
+    path_or_folder: a single .continuous file, or a folder from which the
+                    files given by channels, chprefix, session and source
+                    (see loadFolderToArray) are read.
+
+    The per-record timestamps are binary-searched for the window boundaries,
+    so only the records overlapping the window are read. Samples that fall
+    into recording gaps are simply absent, which is why the timestamp of
+    every returned sample is returned as well.
+
+    Returns a dict with header, timestamps (in samples) and data, which has
+    shape (n_samples,) for a single file and (n_samples, n_channels) for a
+    folder.
+    '''
 
-    ch['header'] = header
-    ch['timestamps'] = timestamps
-    ch['data'] = samples  # OR use downsample(samples,1), to save space
-    ch['recordingNumber'] = recordingNumbers
-    f.close()
-    return ch
+    if os.path.isdir(path_or_folder):
+        filelist = [os.path.join(path_or_folder, f) for f in
+                    get_filelist(path_or_folder, channels, chprefix, session, source)]
+    else:
+        filelist = [path_or_folder]
+
+    conts = [ContinuousMemmap(f, dtype) for f in filelist]
+    sampleRate = float(conts[0].header['sampleRate'])
+    first, last = t_start * sampleRate, t_stop * sampleRate
+
+    start, stop = conts[0].index_of(first), conts[0].index_of(last)
+    for cont in conts[1:]:
+        if (cont.index_of(first), cont.index_of(last)) != (start, stop):
+            raise Exception('Inconsistent records across channels in ' + cont.filepath)
+
+    if os.path.isdir(path_or_folder):
+        data = np.empty((max(stop - start, 0), len(conts)), dtype)
+        for i, cont in enumerate(conts):
+            cont.read(start, stop, out=data[:, i])
+    else:
+        data = conts[0].read(start, stop)
+
+    return {'header': conts[0].header,
+            'timestamps': conts[0].sample_timestamps(start, stop),
+            'data': data}
+
+def _open_channels(folderpath, filelist, dtype = float):
+    '''Memory-map the files of filelist in folderpath as ContinuousMemmaps,
+    raising if they do not all hold the same number of samples.'''
+    conts = [ContinuousMemmap(os.path.join(folderpath, f), dtype) for f in filelist]
+
+    for cont in conts[1:]:
+        if len(cont) != len(conts[0]):
+            raise Exception('Number of samples in ' + cont.filepath + ' differs from ' + conts[0].filepath)
+
+    return conts
+
+def _iter_blocks(sources, chunk_samples, overlap = 0, dtype = float, out = None):
+    '''Yield (start, stop, block) for consecutive blocks of chunk_samples
+    samples, plus overlap on each side, of equally long sources
+    (ContinuousMemmaps or pre-loaded arrays), one source per column of block.
+
+    block is a view of out if given, which is then overwritten by every
+    block, otherwise a new array.'''
+    n_samples = len(sources[0])
+    for chunk_start in range(0, n_samples, chunk_samples):
+        start = max(chunk_start - overlap, 0)
+        stop = min(chunk_start + chunk_samples + overlap, n_samples)
+
+        if out is None:
+            block = np.empty((stop - start, len(sources)), dtype)
+        else:
+            block = out[:stop - start]
+
+        for i, src in enumerate(sources):
+            if isinstance(src, ContinuousMemmap):
+                src.read(start, stop, out=block[:, i])
+            else:
+                block[:, i] = src[start:stop]
+
+        yield start, stop, block
+
+def iter_chunks(folderpath, chunk_samples, overlap = 0, channels = 'all', dtype = float,
+                chprefix = 'CH', session = '0', source = '100', out = None):
+    '''Iterate over a folder of continuous files in blocks of chunk_samples.
+
+    Every channel file is memory-mapped once, when iter_chunks is called, and
+    kept open for the whole iteration, so only the samples of the current
+    block are read and decoded. Channels are selected as in loadFolderToArray.
+
+    overlap: number of extra samples added on each side of every block, e.g.
+             to let filters settle. The margins are clipped at the start and
+             end of the data, so the first block has no leading margin and
+             block k starts min(overlap, k*chunk_samples) samples before its
+             core.
+
+    out: optional array of dtype and shape (chunk_samples + 2*overlap,
+         n_channels), reused for every block. The yielded samples are then
+         views of it, overwritten by the next block.
+
+    Returns an iterator of (timestamps, samples) tuples, where timestamps
+    holds the timestamp of every sample and samples has shape (n, n_channels).
+    '''
+
+    filelist = get_filelist(folderpath, channels, chprefix, session, source)
+    conts = _open_channels(folderpath, filelist, dtype)
+
+    return ((conts[0].sample_timestamps(start, stop), samples)
+            for start, stop, samples in _iter_blocks(conts, chunk_samples, overlap, dtype, out))
 
 def loadSpikes(filepath):
 
@@ -179,64 +463,73 @@ def loadSpikes(filepath):
     f = open(filepath, 'rb')
     header = readHeader(f)
 
-    if float(header[' version']) < 0.4:
+    if float(header['version']) < 0.4:
         raise Exception('Loader is only compatible with .spikes files with version 0.4 or higher')
 
     data['header'] = header
     numChannels = int(header['num_channels'])
     numSamples = 40 # **NOT CURRENTLY WRITTEN TO HEADER**
 
-    spikes = np.zeros((MAX_NUMBER_OF_SPIKES, numSamples, numChannels))
-    timestamps = np.zeros(MAX_NUMBER_OF_SPIKES)
-    source = np.zeros(MAX_NUMBER_OF_SPIKES)
-    gain = np.zeros((MAX_NUMBER_OF_SPIKES, numChannels))
-    thresh = np.zeros((MAX_NUMBER_OF_SPIKES, numChannels))
-    sortedId = np.zeros((MAX_NUMBER_OF_SPIKES, numChannels))
-    recNum = np.zeros(MAX_NUMBER_OF_SPIKES)
-
-    currentSpike = 0
-
-    while f.tell() < os.fstat(f.fileno()).st_size:
-        eventType = np.fromfile(f, np.dtype('<u1'),1) #always equal to 4, discard
-        timestamps[currentSpike] = np.fromfile(f, np.dtype('<i8'), 1)
-        software_timestamp = np.fromfile(f, np.dtype('<i8'), 1)
-        source[currentSpike] = np.fromfile(f, np.dtype('<u2'), 1)
-        numChannels = np.fromfile(f, np.dtype('<u2'), 1)[0]
-        numSamples = np.fromfile(f, np.dtype('<u2'), 1)[0]
-        sortedId[currentSpike] = np.fromfile(f, np.dtype('<u2'),1)
-        electrodeId = np.fromfile(f, np.dtype('<u2'),1)
-        channel = np.fromfile(f, np.dtype('<u2'),1)
-        color = np.fromfile(f, np.dtype('<u1'), 3)
-        pcProj = np.fromfile(f, np.float32, 2)
-        sampleFreq = np.fromfile(f, np.dtype('<u2'),1)
-
-        waveforms = np.fromfile(f, np.dtype('<u2'), numChannels*numSamples)
-        gain[currentSpike,:] = np.fromfile(f, np.float32, numChannels)
-        thresh[currentSpike,:] = np.fromfile(f, np.dtype('<u2'), numChannels)
-        recNum[currentSpike] = np.fromfile(f, np.dtype('<u2'), 1)
-
-        waveforms_reshaped = np.reshape(waveforms, (numChannels, numSamples))
-        waveforms_reshaped = waveforms_reshaped.astype(float)
-        waveforms_uv = waveforms_reshaped
-
-        for ch in range(numChannels):
-            waveforms_uv[ch, :] -= 32768
-            waveforms_uv[ch, :] /= gain[currentSpike, ch]*1000
-
-        spikes[currentSpike] = waveforms_uv.T
-
-        currentSpike += 1
-
-    data['spikes'] = spikes[:currentSpike,:,:]
-    data['timestamps'] = timestamps[:currentSpike]
-    data['source'] = source[:currentSpike]
-    data['gain'] = gain[:currentSpike,:]
-    data['thresh'] = thresh[:currentSpike,:]
-    data['recordingNumber'] = recNum[:currentSpike]
-    data['sortedId'] = sortedId[:currentSpike]
+    # the number of samples is not in the header, but every spike record
+    # repeats it, so take it from the first record
+    fileLength = os.fstat(f.fileno()).st_size
+    firstRecord = f.read(_spike_dtype(0, 0).itemsize)
+    f.close()
+    if len(firstRecord) == _spike_dtype(0, 0).itemsize:
+        numChannels, numSamples = np.frombuffer(firstRecord, '<u2', 2, 19)
+
+    spikeDtype = _spike_dtype(numChannels, numSamples)
+    recordBytes = fileLength - NUM_HEADER_BYTES
+    if recordBytes % spikeDtype.itemsize != 0:
+        raise Exception("File size is not consistent with a spikes file: may be corrupt")
+    numSpikes = recordBytes // spikeDtype.itemsize
+
+    if numSpikes:
+        records = np.memmap(filepath, spikeDtype, mode='r',
+                            offset=NUM_HEADER_BYTES, shape=(numSpikes,))
+    else:
+        records = np.zeros(0, spikeDtype)
+
+    if np.any(records['numChannels'] != numChannels) or np.any(records['numSamples'] != numSamples):
+        raise Exception('Spike records with different number of channels or samples found')
+
+    gain = records['gain'].astype(float)
+
+    # waveforms are stored as (channel, sample) for each spike
+    spikes = records['waveforms'].astype(float)
+    spikes -= 32768
+    spikes /= gain[:, :, None]*1000
+
+    data['spikes'] = spikes.transpose(0, 2, 1)
+    data['timestamps'] = records['timestamp'].astype(float)
+    data['source'] = records['source'].astype(float)
+    data['gain'] = gain
+    data['thresh'] = records['thresh'].astype(float)
+    data['recordingNumber'] = records['recordingNumber'].astype(float)
+    data['sortedId'] = np.repeat(records['sortedId'].astype(float)[:, None], numChannels, 1)
 
     return data
 
+def _spike_dtype(numChannels, numSamples):
+    '''Structured dtype of a single .spikes record with numChannels channels
+    of numSamples samples each.'''
+    return np.dtype([('eventType', '<u1'), #always equal to 4
+                     ('timestamp', '<i8'),
+                     ('softwareTimestamp', '<i8'),
+                     ('source', '<u2'),
+                     ('numChannels', '<u2'),
+                     ('numSamples', '<u2'),
+                     ('sortedId', '<u2'),
+                     ('electrodeId', '<u2'),
+                     ('channel', '<u2'),
+                     ('color', '<u1', (3,)),
+                     ('pcProj', '<f4', (2,)),
+                     ('sampleFreq', '<u2'),
+                     ('waveforms', '<u2', (numChannels, numSamples)),
+                     ('gain', '<f4', (numChannels,)),
+                     ('thresh', '<u2', (numChannels,)),
+                     ('recordingNumber', '<u2')])
+
 
 def loadEvents(filepath):
 
@@ -247,118 +540,247 @@ def loadEvents(filepath):
     f = open(filepath,'rb')
     header = readHeader(f)
 
-    if float(header[' version']) < 0.4:
+    if float(header['version']) < 0.4:
         raise Exception('Loader is only compatible with .events files with version 0.4 or higher')
 
     data['header'] = header
 
-    index = -1
-
-    channel = np.zeros(MAX_NUMBER_OF_EVENTS)
-    timestamps = np.zeros(MAX_NUMBER_OF_EVENTS)
-    sampleNum = np.zeros(MAX_NUMBER_OF_EVENTS)
-    nodeId = np.zeros(MAX_NUMBER_OF_EVENTS)
-    eventType = np.zeros(MAX_NUMBER_OF_EVENTS)
-    eventId = np.zeros(MAX_NUMBER_OF_EVENTS)
-    recordingNumber = np.zeros(MAX_NUMBER_OF_EVENTS)
+    recordBytes = os.fstat(f.fileno()).st_size - NUM_HEADER_BYTES
+    if recordBytes % EVENT_DTYPE.itemsize != 0:
+        f.close()
+        raise Exception("File size is not consistent with an events file: may be corrupt")
 
-    while f.tell() < os.fstat(f.fileno()).st_size:
-
-        index += 1
-
-        timestamps[index] = np.fromfile(f, np.dtype('<i8'), 1)
-        sampleNum[index] = np.fromfile(f, np.dtype('<i2'), 1)
-        eventType[index] = np.fromfile(f, np.dtype('<u1'), 1)
-        nodeId[index] = np.fromfile(f, np.dtype('<u1'), 1)
-        eventId[index] = np.fromfile(f, np.dtype('<u1'), 1)
-        channel[index] = np.fromfile(f, np.dtype('<u1'), 1)
-        recordingNumber[index] = np.fromfile(f, np.dtype('<u2'), 1)
+    # read all events in a single pass
+    events = np.fromfile(f, EVENT_DTYPE, recordBytes // EVENT_DTYPE.itemsize)
+    f.close()
 
-    data['channel'] = channel[:index]
-    data['timestamps'] = timestamps[:index]
-    data['eventType'] = eventType[:index]
-    data['nodeId'] = nodeId[:index]
-    data['eventId'] = eventId[:index]
-    data['recordingNumber'] = recordingNumber[:index]
-    data['sampleNum'] = sampleNum[:index]
+    for field in EVENT_DTYPE.names:
+        data[field] = np.ascontiguousarray(events[field])
 
     return data
 
 def readHeader(f):
+    return _parse_header(f.read(NUM_HEADER_BYTES))
+
+def _parse_header(raw):
+    # keys and values are stripped of the whitespace around them, as
+    # fields are separated by '; ' in some headers and ';\n' in others
     header = { }
-    h = f.read(1024).decode().replace('\n','').replace('header.','')
+    h = raw.decode().replace('\n','').replace('header.','')
     for i,item in enumerate(h.split(';')):
         if '=' in item:
-            header[item.split(' = ')[0]] = item.split(' = ')[1]
+            key, value = item.split(' = ', 1)
+            header[key.strip()] = value.strip()
     return header
 
 def downsample(trace,down):
     downsampled = scipy.signal.resample(trace,np.shape(trace)[0]/down)
     return downsampled
 
+class Reference:
+    '''Digital referencing of int16 blocks of samples, done in place.
+
+    mode:     'ave' (or 'car') for the common average, 'median' for the common
+              median, or a channel to subtract that single channel.
+    channels: channel of each column of the blocks. Needed for a single
+              channel reference, unless the reference samples are passed on
+              each call, and for groups.
+    groups:   channels referenced together, e.g. the channels of each shank
+              of a probe. Either a list of lists of channels, or a dict of
+              them, which can also be a .prb-style channel map
+              ({'0': {'mapping': [...]}, ...}). Each group
+              is referenced to its own average/median (or to the single
+              channel). Columns in no group are left unchanged.
+
+    Every group is referenced at once for all its channels. Differences are
+    computed in float32 (exact for int16), rounded and saturated to the int16
+    range before being written back, so they never wrap around.
+
+    Usage:
+        ref = OpenEphys.Reference('median', channels, groups=[[1,2,3,4], [5,6,7,8]])
+        ref(block)   # for each block of shape (n, len(channels))
+    '''
+
+    def __init__(self, mode, channels = None, groups = None):
+        if isinstance(mode, str) and mode.lower() in ('ave', 'car', 'median'):
+            self.mode = 'median' if mode.lower() == 'median' else 'ave'
+        else:
+            self.mode = 'channel'
+        self.channel = mode
+        self.channels = None if channels is None else list(channels)
+
+        groups = _channel_groups(groups)
+        self.grouped = groups is not None
+        if groups is None:
+            self.columns = [slice(None)]
+        else:
+            if self.channels is None:
+                raise ValueError('channels are needed to reference by groups')
+            self.columns = [np.array([self.channels.index(ch) for ch in g if ch in self.channels], int)
+                            for g in groups]
+            self.columns = [c for c in self.columns if len(c)]
+
+        self.refColumn = None
+        if self.mode == 'channel' and self.channels is not None and self.channel in self.channels:
+            self.refColumn = self.channels.index(self.channel)
+
+        self._work = np.empty((0, 0), np.float32)
+
+    def __str__(self):
+        if self.mode == 'channel':
+            name = 'channel ' + str(self.channel)
+        else:
+            name = {'ave': 'average', 'median': 'median'}[self.mode] + ' of channels'
+        if self.grouped:
+            name += ', in ' + str(len(self.columns)) + ' groups'
+        return name
+
+    def __call__(self, block, ref = None):
+        '''Reference block (n_samples, n_channels) in place and return it.
+
+        ref: samples of the reference channel, for a single channel reference
+             to a channel that is not a column of block.'''
+        if self.mode == 'channel':
+            if ref is None:
+                if self.refColumn is None:
+                    raise ValueError('Reference channel ' + str(self.channel) + ' is not in the block')
+                ref = block[:, self.refColumn]
+            # copied, as the reference column itself is referenced as well
+            ref = ref.astype(np.float32)
+
+        for cols in self.columns:
+            sub = block[:, cols]
+            if self.mode == 'ave':
+                groupRef = sub.mean(axis=1, dtype=np.float64)
+            elif self.mode == 'median':
+                groupRef = np.median(sub, axis=1)
+            else:
+                groupRef = ref
+
+            if self._work.shape[0] < sub.shape[0] or self._work.shape[1] < sub.shape[1]:
+                self._work = np.empty((max(sub.shape[0], self._work.shape[0]),
+                                       max(sub.shape[1], self._work.shape[1])), np.float32)
+            work = self._work[:sub.shape[0], :sub.shape[1]]
+
+            np.subtract(sub, groupRef[:, None], out=work, casting='unsafe')
+            np.rint(work, out=work)
+            np.clip(work, -32768, 32767, out=work)
+            block[:, cols] = work
+
+        return block
+
+def _channel_groups(groups):
+    # list of lists of channels, from a list or a dict of them, or from a
+    # .prb-style channel map
+    if isinstance(groups, dict):
+        groups = [g['mapping'] if isinstance(g, dict) else g for g in groups.values()
+                  if not isinstance(g, dict) or 'mapping' in g]
+    return groups
+
 def pack(folderpath,source='100',**kwargs):
 #convert single channel open ephys channels to a .dat file for compatibility with the KlustaSuite, Neuroscope and Klusters
 #should not be necessary for versions of open ephys which write data into HDF5 format.
-#loads .continuous files in the specified folder and saves a .DAT in that folder
+#streams the .continuous files in the specified folder in blocks and saves a .DAT in that folder
 #optional arguments:
 #   source: string name of the source that openephys uses as the prefix. is usually 100, if the headstage is the first source added, but can specify something different
 #
 #   data: pre-loaded data to be packed into a .DAT
+#   channels: list of .continuous channel numbers to pack. if not provided, every .continuous file in the folder
+#             (CH, AUX, ADC, ...) is packed, ordered by source, prefix, channel number and session.
 #   dref: int specifying a channel # to use as a digital reference. is subtracted from all channels.
+#         'ave' (or 'car') and 'median' reference to the average or median of the packed channels instead.
+#   groups: list (or channel map dict, see Reference) of channel groups, e.g. shanks, referenced separately with dref.
 #   order: the order in which the .continuos files are packed into the .DAT. should be a list of .continious channel numbers. length must equal total channels.
 #   suffix: appended to .DAT filename, which is openephys.DAT if no suffix provided.
+#   chunk_samples: number of samples per channel interleaved and written at once.
+#   progress: callable receiving the number of samples written so far, called once per block. defaults to a ProgressBar.
 
-    #load the openephys data into memory
-    if 'data' not in kwargs.keys():
-        if 'channels' not in kwargs.keys():
-            data = loadFolder(folderpath, dtype = np.int16)
-        else:
-            data = loadFolder(folderpath, dtype = np.int16, channels=kwargs['channels'])
-    else:
-        data = kwargs['data']
-    #if specified, do the digital referencing
-    if 'dref' in kwargs.keys():
-        ref =load(os.path.join(folderpath,''.join((source,'_CH',str(kwargs['dref']),'.continuous'))))
-        for i,channel in enumerate(data.keys()):
-            data[channel]['data'] = data[channel]['data'] - ref['data']
     #specify the order the channels are written in
     if 'order' in kwargs.keys():
         order = kwargs['order']
+    elif 'channels' in kwargs.keys():
+        order = kwargs['channels']
+    elif 'data' in kwargs.keys():
+        order = list(kwargs['data'])
     else:
-        order = list(data)
+        index = get_folder_index(folderpath)
+        order = [os.path.basename(index[key][0]).replace('.continuous', '') for key in sorted(index)]
+    names = [_channel_name(ch, source) for ch in order]
+
+    #map the channels instead of loading them into memory
+    if 'data' in kwargs.keys():
+        sources = [_data_channel(kwargs['data'], ch, source)['data'] for ch in order]
+        if any(len(src) != len(sources[0]) for src in sources):
+            raise Exception('Channels to pack have different numbers of samples')
+    else:
+        sources = _open_channels(folderpath, [name + '.continuous' for name in names], np.int16)
+
+    n_samples = len(sources[0])
+
+    #if specified, do the digital referencing
+    reference, ref = None, None
+    if 'dref' in kwargs.keys():
+        dref = kwargs['dref']
+        groups = _channel_groups(kwargs.get('groups'))
+        if groups is not None:
+            groups = [[_channel_name(ch, source) for ch in g] for g in groups]
+
+        if isinstance(dref, str) and dref.lower() in ('ave', 'car', 'median'):
+            reference = Reference(dref, names, groups)
+        else:
+            reference = Reference(_channel_name(dref, source), names, groups)
+            if reference.refColumn is None:
+                ref = ContinuousMemmap(os.path.join(folderpath, _channel_name(dref, source) + '.continuous'), np.int16)
+        print('Digital referencing to ' + str(reference))
+
     #add a suffix, if one was specified
     if 'suffix' in kwargs.keys():
         suffix=kwargs['suffix']
     else:
         suffix=''
 
+    chunk_samples = kwargs.get('chunk_samples', MAX_RECORDS_PER_READ * SAMPLES_PER_RECORD // 16)
+    progress = kwargs.get('progress')
+    if progress is None:
+        bar = ProgressBar(n_samples)
+        progress = lambda written: bar.animate(written - 1)
+
     #make a file to write the data back out into .dat format
     outpath = os.path.join(folderpath,''.join(('openephys',suffix,'.dat')))
-    out = open(outpath,'wb')
 
-    #go through the data and write it out in the .dat format
+    #go through the data in blocks, interleave them into a reusable buffer and write it out in the .dat format
     #.dat format specified here: http://neuroscope.sourceforge.net/UserManual/data-files.html
-    channelOrder = []
     print(''.join(('...saving .dat to ',outpath,'...')))
-    random_datakey = next(iter(data))
-    bar = ProgressBar(len(data[random_datakey]['data']))
-    for i in range(len(data[random_datakey]['data'])):
-        for j in range(len(order)):
-            if source in random_datakey:
-                ch = data[order[j]]['data']
-            else:
-                ch = data[''.join(('CH',str(order[j]).replace('CH','')))]['data']
-            out.write(struct.pack('h',ch[i]))#signed 16-bit integer
-            #figure out which order this thing packed the channels in. only do this once.
-            if i == 0:
-                channelOrder.append(order[j])
-        #update how mucb we have list
-        if i%(len(data[random_datakey]['data'])/100)==0:
-            bar.animate(i)
-    out.close()
-    print(''.join(('order: ',str(channelOrder))))
+    buffer = np.empty((chunk_samples, len(sources)), np.int16)
+    refBuffer = np.empty(chunk_samples, np.int16)
+    with open(outpath,'wb') as out:
+        for start, stop, block in _iter_blocks(sources, chunk_samples, out=buffer):
+            if reference is not None:
+                reference(block, None if ref is None else ref.read(start, stop, out=refBuffer[:stop - start]))
+
+            block.tofile(out) #signed 16-bit integers
+            progress(stop)
+
+    print(''.join(('order: ',str(list(order)))))
     print(''.join(('.dat saved to ',outpath)))
 
+def _channel_name(channel, source='100'):
+    # accepts a channel number, 'CH1'-style names or '100_CH1'-style keys, as returned by loadFolder
+    channel = str(channel)
+    if channel.isdigit():
+        return source + '_CH' + channel
+    if CONTINUOUS_FILENAME.match(channel + '.continuous') is None:
+        return source + '_' + channel
+    return channel
+
+def _data_channel(data, channel, source='100'):
+    # pre-loaded data may be keyed as '100_CH1' (as returned by loadFolder) or as 'CH1'
+    name = _channel_name(channel, source)
+    for key in (channel, name, name.split('_', 1)[1]):
+        if key in data:
+            return data[key]
+    raise KeyError(channel)
+
 #**********************************************************
 # progress bar class used to show progress of pack()
     #stolen from some post on stack overflow
@@ -385,6 +807,11 @@ class ProgressBar:
         sys.stdout.flush()
         self.update_iteration(iter + 1)
 
+    def animate_noipython(self, iter):
+        print('\r', self, end='')
+        sys.stdout.flush()
+        self.update_iteration(iter + 1)
+
     def update_iteration(self, elapsed_iter):
         self.__update_amount((elapsed_iter / float(self.iterations)) * 100.0)
         self.prog_bar += '  %d of %s complete' % (elapsed_iter, self.iterations)
@@ -404,7 +831,8 @@ class ProgressBar:
 #*************************************************************
 
 def pack_2(folderpath, filename = '', channels = 'all', chprefix = 'CH',
-           dref = None, session = '0', source = '100'):
+           dref = None, session = '0', source = '100', groups = None,
+           chunk_samples = MAX_RECORDS_PER_READ * SAMPLES_PER_RECORD // 16):
 
     '''Alternative version of pack which uses numpy's tofile function to write data.
     pack_2 is much faster than pack and avoids quantization noise incurred in pack due
@@ -420,48 +848,229 @@ def pack_2(folderpath, filename = '', channels = 'all', chprefix = 'CH',
     chprefix:  String name that defines if channels from headstage, auxiliary or ADC inputs
                will be loaded.
 
-    dref:  Digital referencing - either supply a channel number or 'ave' to reference to the
-           average of packed channels.
+    dref:  Digital referencing - either supply a channel number, 'ave' (or 'car') to reference
+           to the average of packed channels, or 'median' to reference to their median.
 
     source: String name of the source that openephys uses as the prefix. It is usually 100,
             if the headstage is the first source added, but can specify something different.
 
+    groups: Channel groups (e.g. shanks) referenced separately with dref, see Reference.
+
+    chunk_samples: Number of samples per channel read, referenced and written at once, so the
+                   whole session never needs to be in memory.
+
     '''
 
-    data_array = loadFolderToArray(folderpath, channels, chprefix, np.int16, session, source)
+    if channels == 'all':
+        channels = _get_sorted_channels(folderpath, chprefix, session, source)
+    blocks = iter_chunks(folderpath, chunk_samples, channels=channels, dtype=np.int16,
+                         chprefix=chprefix, session=session, source=source,
+                         out=np.empty((chunk_samples, len(channels)), np.int16))
 
+    reference = None
     if dref:
-        if dref == 'ave':
-            print('Digital referencing to average of all channels.')
-            reference = np.mean(data_array,1)
-        else:
-            print('Digital referencing to channel ' + str(dref))
-            if channels == 'all':
-                channels = _get_sorted_channels(folderpath, chprefix, session, source)
-            reference = deepcopy(data_array[:,channels.index(dref)])
-        for i in range(data_array.shape[1]):
-            data_array[:,i] = data_array[:,i] - reference
+        reference = Reference(dref, list(channels), groups)
+        if reference.mode == 'channel' and reference.refColumn is None:
+            raise ValueError('Reference channel ' + str(dref) + ' is not in channels')
+        print('Digital referencing to ' + str(reference))
 
     if session == '0': session = ''
     else: session = '_'+session
 
     if not filename: filename = source + '_' + chprefix + 's' + session + '.dat'
     print('Packing data to file: ' + filename)
-    data_array.tofile(os.path.join(folderpath,filename))
 
+    with open(os.path.join(folderpath,filename), 'wb') as out:
+        for _, block in blocks:
+            if reference is not None:
+                reference(block)
 
-def _get_sorted_channels(folderpath, chprefix='CH', session='0', source='100'):
-    Files = [f for f in os.listdir(folderpath) if '.continuous' in f
-                                               and '_'+chprefix in f
-                                               and source in f]
+            block.tofile(out)
+
+
+def get_filelist(folderpath, channels = 'all', chprefix = 'CH', session = '0', source = '100'):
+    '''Return the .continuous filenames in folderpath for the given channel
+    numbers, or for all channels with chprefix in numerical order.'''
+    if channels == 'all':
+        channels = _get_sorted_channels(folderpath, chprefix, session, source)
 
     if session == '0':
-        Files = [f for f in Files if len(f.split('_')) == 2]
-        Chs = sorted([int(f.split('_'+chprefix)[1].split('.')[0]) for f in Files])
+        return [source + '_'+chprefix + x + '.continuous' for x in map(str,channels)]
     else:
-        Files = [f for f in Files if len(f.split('_')) == 3
-                                  and f.split('.')[0].split('_')[2] == session]
+        return [source + '_'+chprefix + x + '_' + session + '.continuous' for x in map(str,channels)]
 
-        Chs = sorted([int(f.split('_'+chprefix)[1].split('_')[0]) for f in Files])
+def _get_sorted_channels(folderpath, chprefix='CH', session='0', source='100'):
+    index = get_folder_index(folderpath)
+    return sorted(ch for (src, prefix, ch, sess) in index
+                  if src == source and prefix == chprefix and sess == session)
+
+# folder -> (mtime_ns, index, listing time in ns), see get_folder_index
+_folder_indexes = {}
+
+# listings taken this soon after a folder's last change are not reused
+FOLDER_INDEX_RACY_SECONDS = 2
+
+def get_folder_index(folderpath):
+    '''Return an index of the .continuous files in folderpath, mapping
+    (source, chprefix, channel, session) to (path, size), e.g.
+    ('100', 'CH', 1, '0') for 100_CH1.continuous or ('100', 'AUX', 2, '3')
+    for 100_AUX2_3.continuous.
+
+    The folder is listed once with os.scandir and matched against
+    CONTINUOUS_FILENAME. The index is cached per folder and rebuilt only when
+    the folder's mtime changes (i.e. files are added, removed or renamed), so
+    sizes are the ones at the time the index was built. On filesystems with
+    coarse mtimes a file created right after the listing may not change the
+    mtime, so listings taken less than FOLDER_INDEX_RACY_SECONDS after the
+    folder's last change are not reused.
+    '''
+    key = os.path.abspath(folderpath)
+    mtime = os.stat(key).st_mtime_ns
+
+    cached = _folder_indexes.get(key)
+    if cached is not None and cached[0] == mtime and \
+            cached[2] - mtime >= FOLDER_INDEX_RACY_SECONDS * 10**9:
+        return cached[1]
+
+    listedAt = time.time_ns()
+    index = {}
+    with os.scandir(key) as entries:
+        for entry in entries:
+            match = CONTINUOUS_FILENAME.match(entry.name)
+            if match is not None:
+                src, prefix, ch, sess = match.groups()
+                index[(src, prefix, int(ch), sess or '0')] = (entry.path, entry.stat().st_size)
+
+    _folder_indexes[key] = (mtime, index, listedAt)
+    return index
+
+
+def get_number_of_records(filepath):
+    '''Return the number of records in a .continuous file, using the
+    blockLength from its header.'''
+    with open(filepath, 'rb') as f:
+        header = readHeader(f)
+        fileLength = os.fstat(f.fileno()).st_size
+
+    return _number_of_records(fileLength, int(header.get('blockLength', SAMPLES_PER_RECORD)))
+
+def _number_of_records(fileLength, blockLength = SAMPLES_PER_RECORD):
+    # each record has size 2*N + 22 bytes, see _record_dtype
+    recordBytes = fileLength - NUM_HEADER_BYTES
+    recordSize = _record_dtype(blockLength).itemsize
+    if recordBytes < 0 or recordBytes % recordSize != 0:
+        raise Exception("File size is not consistent with a continuous file: may be corrupt")
+    return recordBytes // recordSize
+
+def _read_raw_header(filepath):
+    # a single open and positional read per file, with no seek or buffering
+    if not hasattr(os, 'pread'):
+        with open(filepath, 'rb') as f:
+            return f.read(NUM_HEADER_BYTES)
+
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        return os.pread(fd, NUM_HEADER_BYTES, 0)
+    finally:
+        os.close(fd)
+
+def scan_headers(folderpath, filelist = None, n_jobs = 1, **kwargs):
+    '''Read the headers of many .continuous files in folderpath at once.
+
+    Each file is opened once and its 1024-byte header read with a single
+    pread, optionally across n_jobs threads. File sizes (and mtimes) come from
+    one os.scandir pass over the folder, so no extra stat or open is needed to
+    count the records.
+
+    filelist: file names within folderpath. If None, the keyword arguments
+              (channels, chprefix, session, source) are passed to get_filelist.
+
+    Returns a per-channel header table: a dict of columns with one row per
+    file, in filelist order. It holds 'filename', 'size', 'mtime_ns' and
+    'n_records', plus every header field, with HEADER_FLOAT_KEYS and
+    HEADER_INT_KEYS as numpy arrays and the remaining fields as lists of
+    strings.
+    '''
+    if filelist is None:
+        filelist = get_filelist(folderpath, **kwargs)
+
+    wanted = set(filelist)
+    stats = {}
+    with os.scandir(folderpath) as entries:
+        for entry in entries:
+            if entry.name in wanted:
+                stats[entry.name] = entry.stat()
+
+    paths = [os.path.join(folderpath, f) for f in filelist]
+    if n_jobs == 1:
+        raws = [_read_raw_header(p) for p in paths]
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            raws = list(pool.map(_read_raw_header, paths))
+
+    headers = [_parse_header(raw) for raw in raws]
+    for f, p in zip(filelist, paths):
+        if f not in stats: stats[f] = os.stat(p)
+
+    table = {'filename': list(filelist),
+             'size': np.array([stats[f].st_size for f in filelist], dtype=np.int64),
+             'mtime_ns': np.array([stats[f].st_mtime_ns for f in filelist], dtype=np.int64)}
+
+    for key in dict.fromkeys(k for h in headers for k in h):
+        column = [h.get(key, '') for h in headers]
+        if key in HEADER_FLOAT_KEYS:
+            column = np.array(column, dtype=float)
+        elif key in HEADER_INT_KEYS:
+            column = np.array(column, dtype=np.int64)
+        table[key] = column
+
+    if 'blockLength' not in table:
+        table['blockLength'] = np.full(len(filelist), SAMPLES_PER_RECORD, dtype=np.int64)
+
+    # same computation as _number_of_records, for all files at once
+    recordBytes = table['size'] - NUM_HEADER_BYTES
+    recordSize = 2 * table['blockLength'] + 22
+    bad = (recordBytes < 0) | (recordBytes % recordSize != 0)
+    if bad.any():
+        raise Exception("File size is not consistent with a continuous file: may be corrupt ("
+                        + table['filename'][np.flatnonzero(bad)[0]] + ")")
+    table['n_records'] = recordBytes // recordSize
+
+    return table
+
+def get_header_from_folder(folderpath, filelist = None, n_jobs = 1, **kwargs):
+    '''Return the header shared by the .continuous files in folderpath.
+
+    The keys in HEADER_CONSISTENT_KEYS, and the number of records, are
+    checked for consistency across all files (floats with np.isclose) and
+    returned in a single dict, with numeric values converted, and the number
+    of records as 'n_records'.
+
+    filelist, n_jobs and kwargs are passed to scan_headers, which also
+    returns the per-channel headers.
+
+    Returns a dict, as the Python 2 version of this function.
+    '''
+    table = scan_headers(folderpath, filelist, n_jobs, **kwargs)
+    if not table['filename']:
+        raise IOError("no headers could be loaded")
+
+    header = {}
+    for key in HEADER_CONSISTENT_KEYS + ('n_records',):
+        if key not in table: continue
+        column = table[key]
+        if isinstance(column, np.ndarray):
+            if column.dtype.kind == 'f':
+                same = np.isclose(column, column[0]).all()
+            else:
+                same = (column == column[0]).all()
+            value = column[0].item()
+        else:
+            same = len(set(column)) == 1
+            value = column[0]
+
+        if not same:
+            raise ValueError("inconsistent header info in key %s" % key)
+        header[key] = value
 
-    return(Chs)
+    return header
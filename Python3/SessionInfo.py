@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Metadata of an Open Ephys session folder, gathered from settings.xml,
+the structure.oebin files of Binary recordings and the headers of
+.continuous files.
+
+Each source is read at most once, only when a value depending on it is
+first requested, and derived values (channel lists, bit_volts vectors,
+sampling rates, record counts) are memoized in the object. Everything read
+is saved as a json sidecar (SidecarFile) in the session folder, or in
+Binary.IndexCacheDir if the folder is not writable, so later processes only
+stat the files instead of parsing them again. Entries are validated against
+the mtime and size of their source file.
+
+Examples:
+    import SessionInfo
+
+    Info = SessionInfo.SessionInfo('/home/user/PathToData/2019-07-27_00-00-00')
+
+    # From settings.xml:
+    RecChs, ProcNames = Info.RecChs(), Info.ProcNames()
+
+    # From .continuous headers or structure.oebin, whichever is present:
+    Channels = Info.Channels('100')
+    BitVolts = Info.BitVolts('100')
+    Rate = Info.Rate('100')
+
+    # From .continuous headers only:
+    NRecords = Info.NRecords('100')
+
+"""
+
+import numpy as np
+import os
+
+import Binary
+import OpenEphys
+import SettingsXML
+
+
+SidecarFile = '.session_info.json'
+SidecarVersion = 2
+
+
+def ContinuousEntries(Folder, Files, NJobs=1):
+    """
+    Return the header, file stat and number of records of each .continuous
+    file in Files, from a single batched scan (see OpenEphys.scan_headers).
+    """
+    Table = OpenEphys.scan_headers(Folder, Files, NJobs)
+    Keys = [K for K in Table if K not in ('filename', 'size', 'mtime_ns', 'n_records')]
+
+    Entries = {}
+    for F, File in enumerate(Table['filename']):
+        Entries[File] = {
+            'Stat': [int(Table['mtime_ns'][F]), int(Table['size'][F])],
+            'Header': {K: (Table[K][F].item() if isinstance(Table[K], np.ndarray) else Table[K][F])
+                       for K in Keys},
+            'NRecords': int(Table['n_records'][F])
+        }
+
+    return(Entries)
+
+
+class SessionInfo:
+    """
+    Lazily read and memoized metadata of the session in Folder.
+
+    Parameters
+        Folder: str
+            Session folder, containing settings.xml, the .continuous files
+            and/or the experimentX subfolders of Binary recordings.
+
+        Save: bool, optional
+            If True (default), write the sidecar file whenever a source is
+            (re)read, so later instances start from it.
+
+        NJobs: int, optional
+            Number of threads reading .continuous headers.
+    """
+
+    def __init__(self, Folder, Save=True, NJobs=1):
+        self.Folder = Folder
+        self.Save = Save
+        self.NJobs = NJobs
+
+        Sidecar = Binary.ReadIndex(Folder, SidecarFile, SidecarVersion)
+        self.Sources = {
+            'Version': SidecarVersion,
+            'Settings': Sidecar.get('Settings', {}),
+            'Continuous': Sidecar.get('Continuous', {}),
+        }
+        self.Checked = set()
+        self.Memo = {}
+        self.BinaryIndex = None
+
+    def Write(self):
+        if self.Save: Binary.WriteIndex(self.Folder, self.Sources, SidecarFile)
+
+    def Memoize(self, Key, Fun):
+        if Key not in self.Memo: self.Memo[Key] = Fun()
+        return(self.Memo[Key])
+
+    def Settings(self):
+        """
+        Return the recorded channels, processor names and sampling rate from
+        settings.xml, or an empty dict if there is no settings.xml.
+        """
+        if 'Settings' in self.Checked: return(self.Sources['Settings'])
+
+        File = os.path.join(self.Folder, 'settings.xml')
+        try:
+            Stat = Binary.FileStat(File)
+        except OSError:
+            Stat = None
+
+        Settings = self.Sources['Settings']
+        if Stat is None:
+            Settings = {}
+        elif Settings.get('Stat') != Stat:
+            RecChs, ProcNames = SettingsXML.GetRecChs(File)
+            Settings = {'Stat': Stat, 'RecChs': RecChs, 'ProcNames': ProcNames,
+                        'Rate': SettingsXML.GetSamplingRate(File)}
+
+        if Settings != self.Sources['Settings']:
+            self.Sources['Settings'] = Settings; self.Write()
+
+        self.Checked.add('Settings')
+        return(Settings)
+
+    def Continuous(self):
+        """
+        Return the header, stat and number of records of each .continuous
+        file in Folder, keyed by file name. Only new or changed files are
+        opened, all in one batch, and each of them only once.
+        """
+        if 'Continuous' in self.Checked: return(self.Sources['Continuous'])
+
+        Old = self.Sources['Continuous']
+        Continuous, Changed = {}, []
+        for Entry in os.scandir(self.Folder):
+            if not OpenEphys.CONTINUOUS_FILENAME.match(Entry.name): continue
+
+            Stat = Entry.stat()
+            if Entry.name in Old and Old[Entry.name]['Stat'] == [Stat.st_mtime_ns, Stat.st_size]:
+                Continuous[Entry.name] = Old[Entry.name]
+            else:
+                Changed.append(Entry.name)
+
+        if Changed: Continuous.update(ContinuousEntries(self.Folder, Changed, self.NJobs))
+
+        if Continuous != Old:
+            self.Sources['Continuous'] = Continuous; self.Write()
+
+        self.Checked.add('Continuous')
+        return(Continuous)
+
+    def Index(self):
+        """
+        Return the Binary session index (see Binary.GetIndex), which is kept
+        in its own sidecar.
+        """
+        if self.BinaryIndex is None:
+            try:
+                self.BinaryIndex = Binary.GetIndex(self.Folder, Save=self.Save)
+            except OSError:
+                self.BinaryIndex = {'Recordings': {}}
+
+        return(self.BinaryIndex)
+
+    def Refresh(self):
+        """
+        Forget memoized values, so that sources are checked again against
+        the files on disk on next access.
+        """
+        self.Checked.clear(); self.Memo.clear()
+        self.BinaryIndex = None
+
+    def RecChs(self):
+        return(self.Settings().get('RecChs', {}))
+
+    def ProcNames(self):
+        return(self.Settings().get('ProcNames', {}))
+
+    def Files(self, Processor='100', ChPrefix='CH', Session='0'):
+        """
+        Return the .continuous file names of Processor with ChPrefix and
+        Session, sorted by channel number.
+        """
+        def Fun():
+            Files = []
+            for Name in self.Continuous():
+                Source, Prefix, Ch, Sess = OpenEphys.CONTINUOUS_FILENAME.match(Name).groups()
+                if Source == Processor and Prefix == ChPrefix and (Sess or '0') == Session:
+                    Files.append((int(Ch), Name))
+
+            return([Name for Ch, Name in sorted(Files)])
+
+        return(self.Memoize(('Files', Processor, ChPrefix, Session), Fun))
+
+    def Streams(self, Processor=None, Experiment=None, Recording=None):
+        return(Binary.Plan(self.Index(), Processor, Experiment, Recording))
+
+    def Channels(self, Processor='100', ChPrefix='CH', Session='0', Experiment=None, Recording=None):
+        """
+        Return the channel numbers of Processor's .continuous files or, if
+        there are none, the channel names of its first Binary stream.
+        """
+        def Fun():
+            Files = self.Files(Processor, ChPrefix, Session)
+            if Files:
+                return([int(OpenEphys.CONTINUOUS_FILENAME.match(_).group(3)) for _ in Files])
+
+            Streams = self.Streams(Processor, Experiment, Recording)
+            return(Streams[0]['ChNames'] if Streams else [])
+
+        return(self.Memoize(('Channels', Processor, ChPrefix, Session, Experiment, Recording), Fun))
+
+    def BitVolts(self, Processor='100', ChPrefix='CH', Session='0', Experiment=None, Recording=None):
+        """
+        Return the bit_volts of each channel, in the same order as Channels.
+        """
+        def Fun():
+            Files = self.Files(Processor, ChPrefix, Session)
+            if Files:
+                Continuous = self.Continuous()
+                return(np.array([float(Continuous[_]['Header']['bitVolts']) for _ in Files]))
+
+            Streams = self.Streams(Processor, Experiment, Recording)
+            return(np.array(Streams[0]['BitVolts'] if Streams else []))
+
+        return(self.Memoize(('BitVolts', Processor, ChPrefix, Session, Experiment, Recording), Fun))
+
+    def Rate(self, Processor='100', Experiment=None, Recording=None):
+        """
+        Return the sampling rate of Processor from its .continuous headers,
+        its Binary streams or, as a last resort, from settings.xml.
+        """
+        def Fun():
+            for Name, Entry in sorted(self.Continuous().items()):
+                if OpenEphys.CONTINUOUS_FILENAME.match(Name).group(1) == Processor:
+                    return(float(Entry['Header']['sampleRate']))
+
+            Streams = self.Streams(Processor, Experiment, Recording)
+            if Streams: return(float(Streams[0]['Rate']))
+
+            return(self.Settings().get('Rate'))
+
+        return(self.Memoize(('Rate', Processor, Experiment, Recording), Fun))
+
+    def NRecords(self, Processor='100', ChPrefix='CH', Session='0'):
+        """
+        Return the number of records of each .continuous file of Processor,
+        as a dict keyed by channel number.
+        """
+        def Fun():
+            Continuous = self.Continuous()
+            return({int(OpenEphys.CONTINUOUS_FILENAME.match(_).group(3)): Continuous[_]['NRecords']
+                    for _ in self.Files(Processor, ChPrefix, Session)})
+
+        return(self.Memoize(('NRecords', Processor, ChPrefix, Session), Fun))
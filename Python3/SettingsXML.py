@@ -23,6 +23,10 @@ Examples:
     # To get also the processor names:
     RecChs, PluginNames = SettingsXML.GetRecChs(File)
 
+    # To get only processors, channels and record flags, in a single
+    # streaming pass (cached until the file changes on disk):
+    Chains = SettingsXML.ParseSettings(File)
+
     # RecChs will be a dictionary:
     #
     # RecChs
@@ -35,8 +39,10 @@ Examples:
 
 """
 
+import os
 from xml.etree import ElementTree
 
+ParsedCache = {}
 
 
 def FindRecProcs(Ch, Proc, RecChs):
@@ -52,7 +58,7 @@ def FindRecProcs(Ch, Proc, RecChs):
 
 def Root2Dict(El):
     Dict = {}
-    if El.getchildren():
+    if len(El):
         for SubEl in El:
             if SubEl.keys():
                 if SubEl.get('name'):
@@ -88,20 +94,94 @@ def XML2Dict(File):
     return(Info)
 
 
+def IterProcessors(File):
+    """
+    Stream settings.xml with iterparse, yielding one dict per PROCESSOR
+    as soon as its closing tag is read. Only the processor attributes,
+    its CHANNEL_INFO and CHANNEL entries (with SELECTIONSTATE) and its
+    EDITOR attributes are kept; everything else is discarded on the fly.
+    """
+    Stack = []; Chain = -1; Proc = None; Ch = None
+
+    for Event, El in ElementTree.iterparse(File, events=('start', 'end')):
+        if Event == 'start':
+            Parent = Stack[-1] if Stack else None
+            Stack.append(El.tag)
+
+            if El.tag == 'SIGNALCHAIN' and Parent == 'SETTINGS': Chain += 1
+            elif El.tag == 'PROCESSOR' and Parent == 'SIGNALCHAIN':
+                Proc = {
+                    'SignalChain': Chain, 'Attrs': dict(El.items()),
+                    'CHANNEL_INFO': [], 'CHANNEL': {}, 'EDITOR': {}
+                }
+            elif El.tag == 'CHANNEL' and Parent == 'PROCESSOR' and Proc is not None:
+                Ch = dict(El.items())
+
+            continue
+
+        Stack.pop()
+        Parent = Stack[-1] if Stack else None
+
+        if Proc is None:
+            if El.tag == 'SIGNALCHAIN': El.clear()
+            continue
+
+        if El.tag == 'PROCESSOR' and Parent == 'SIGNALCHAIN':
+            yield(Proc)
+            Proc = None; El.clear()
+
+        elif El.tag == 'CHANNEL' and Parent == 'CHANNEL_INFO':
+            Proc['CHANNEL_INFO'].append(dict(El.items()))
+
+        elif El.tag == 'SELECTIONSTATE' and Parent == 'CHANNEL' and Ch is not None:
+            Ch['SELECTIONSTATE'] = dict(El.items())
+
+        elif El.tag == 'CHANNEL' and Parent == 'PROCESSOR':
+            Proc['CHANNEL'][Ch.get('name')] = Ch; Ch = None
+
+        elif El.tag == 'EDITOR' and Parent == 'PROCESSOR':
+            Proc['EDITOR'] = dict(El.items())
+
+
+def ParseSettings(File):
+    """
+    Return the list of signal chains in settings.xml, each one a list of
+    processor dicts as yielded by IterProcessors. The result is cached per
+    file and reused until the file's mtime or size change, so
+    GetSamplingRate and GetRecChs share a single parse.
+    """
+    Key = os.path.abspath(File); Stat = os.stat(Key)
+    Version = (Stat.st_mtime_ns, Stat.st_size)
+
+    if Key in ParsedCache and ParsedCache[Key][0] == Version:
+        return(ParsedCache[Key][1])
+
+    Chains = []
+    for Proc in IterProcessors(Key):
+        while len(Chains) <= Proc['SignalChain']: Chains.append([])
+        Chains[Proc['SignalChain']].append(Proc)
+
+    ParsedCache[Key] = (Version, Chains)
+    return(Chains)
+
+
 def GetSamplingRate(File):
-    Info = XML2Dict(File)
+    Chains = ParseSettings(File)
     Error = 'Cannot parse sample rate. Check your settings.xml file at SIGNALCHAIN>PROCESSOR>Sources/Rhythm FPGA.'
-    SignalChains = [_ for _ in Info.keys() if 'SIGNALCHAIN' in _]
+    Rate = None
 
     try:
-        for SignalChain in SignalChains:
-            if 'Sources/Rhythm FPGA' in Info[SignalChain]['PROCESSOR'].keys():
-                if 'SampleRateString' in Info[SignalChain]['PROCESSOR']['Sources/Rhythm FPGA']['EDITOR']:
-                    Rate = Info[SignalChain]['PROCESSOR']['Sources/Rhythm FPGA']['EDITOR']['SampleRateString']
-                    Rate = float(Rate.split(' ')[0])*1000
-                elif Info[SignalChain]['PROCESSOR']['Sources/Rhythm FPGA']['EDITOR']['SampleRate'] == '17':
+        for Chain in Chains:
+            Editor = [P['EDITOR'] for P in Chain
+                      if P['Attrs'].get('name') == 'Sources/Rhythm FPGA']
+
+            if Editor:
+                Editor = Editor[-1]
+                if 'SampleRateString' in Editor:
+                    Rate = float(Editor['SampleRateString'].split(' ')[0])*1000
+                elif Editor['SampleRate'] == '17':
                     Rate = 30000
-                elif Info[SignalChain]['PROCESSOR']['Sources/Rhythm FPGA']['EDITOR']['SampleRate'] == '16':
+                elif Editor['SampleRate'] == '16':
                     Rate = 25000
                 else:
                     Rate = None
@@ -118,47 +198,40 @@ def GetSamplingRate(File):
 
 
 def GetRecChs(File):
-    Info = XML2Dict(File)
-    RecChs = {}; ProcNames = {}
-
-    if len([k for k in Info if 'SIGNALCHAIN' in k]) > 1:
-        for S in [k for k in Info if 'SIGNALCHAIN_' in k]:
-            for P, Proc in Info[S]['PROCESSOR'].items():
-                Info['SIGNALCHAIN']['PROCESSOR'][P+'_'+S[-1]] = Proc
-            del(Info[S])
-    #     print('There are more than one signal chain in file. )
-    #     Ind = input(')
-
-    for P, Proc in Info['SIGNALCHAIN']['PROCESSOR'].items():
-        if 'isSource' in Proc:
-            if Proc['isSource'] == '1': SourceProc = P[:]
-        else:
-            if Proc['name'].split('/')[0] == 'Sources': SourceProc = P[:]
-
-        if 'CHANNEL_INFO' in Proc and Proc['CHANNEL_INFO']:
-            for Ch in Proc['CHANNEL_INFO']['CHANNEL'].values():
-                RecChs = FindRecProcs(Ch, Proc, RecChs)
+    Chains = ParseSettings(File)
+    RecChs = {}; ProcNames = {}; SourceProc = None
 
-        elif 'CHANNEL' in Proc:
-            for Ch in Proc['CHANNEL'].values():
-                RecChs = FindRecProcs(Ch, Proc, RecChs)
+    for Proc in [P for Chain in Chains for P in Chain]:
+        Attrs = Proc['Attrs']
+        if 'isSource' in Attrs:
+            if Attrs['isSource'] == '1': SourceProc = Proc
+        else:
+            if Attrs['name'].split('/')[0] == 'Sources': SourceProc = Proc
 
+        if Proc['CHANNEL_INFO']:
+            Channels = [dict(Ch) for Ch in Proc['CHANNEL_INFO']]
+        elif Proc['CHANNEL']:
+            Channels = [dict(Ch) for Ch in Proc['CHANNEL'].values()]
         else: continue
 
-        if 'pluginName' in Proc:
-            ProcNames[Proc['NodeId']] = Proc['pluginName']
+        # Same shape as the nested dicts from XML2Dict
+        ProcDict = dict(Attrs, CHANNEL=Proc['CHANNEL'])
+        for Ch in Channels:
+            RecChs = FindRecProcs(Ch, ProcDict, RecChs)
+
+        if 'pluginName' in Attrs:
+            ProcNames[Attrs['NodeId']] = Attrs['pluginName']
         else:
-            ProcNames[Proc['NodeId']] = Proc['name']
+            ProcNames[Attrs['NodeId']] = Attrs['name']
 
-    if Info['SIGNALCHAIN']['PROCESSOR'][SourceProc]['CHANNEL_INFO']:
-        SourceProc = Info['SIGNALCHAIN']['PROCESSOR'][SourceProc]['CHANNEL_INFO']['CHANNEL']
+    if SourceProc['CHANNEL_INFO']:
+        SourceChs = SourceProc['CHANNEL_INFO']
     else:
-        SourceProc = Info['SIGNALCHAIN']['PROCESSOR'][SourceProc]['CHANNEL']
+        SourceChs = list(SourceProc['CHANNEL'].values())
 
     for P, Proc in RecChs.items():
         for C, Ch in Proc.items():
             if 'gain' not in Ch:
-                RecChs[P][C].update([c for c in SourceProc.values() if c['number'] == C][0])
+                RecChs[P][C].update([c for c in SourceChs if c['number'] == C][0])
 
     return(RecChs, ProcNames)
-